@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures how the job engine scales with the size of workflows.
+
+Synthetic workflows are run through WorkflowManager and WorkQueueService
+against the in-process work_queue of benchmarks/fake, which completes
+tasks after the configured latency and fails them at the configured rate.
+The jobs form parallel chains where the output of a job is the input of
+the next one in its chain. Each size is run in its own process so the
+peak resident memory is measured separately. With --queues the jobs are
+spread over several work queues by the --routing policy.
+
+    python benchmarks/engine.py --jobs 10 1000 100000 --latency 0.01
+
+The reported values are:
+
+    submit       seconds spent in WorkflowManager.submit per workflow
+    jobs/s       jobs completed per second from the first submit
+    next (ms)    median and 95th percentile time from a completed task
+                 being received to the next task being submitted
+    peak rss     peak resident memory of the process in megabytes
+    writes       rows written by the store and the store calls made
+"""
+from __future__ import division, print_function
+
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import sleep, time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+#: The fake work_queue must shadow the real bindings
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks', 'fake'))
+sys.path.insert(1, ROOT)
+
+import work_queue
+
+from yerba.core import (EventNotifier, DONE_STATUS, Status, TASK_DONE,
+                        CANCEL_TASK, SCHEDULE_TASK, INPUTS_MISSING)
+from yerba.db import setup
+from yerba.managers import ServiceManager, WorkflowManager
+from yerba.metrics import STORE_SECONDS, DISPATCH_WAIT_SECONDS
+from yerba.services import ExecutorRouter
+from yerba.workqueue import WorkQueueService
+
+SIZES = (10, 100, 1000, 10000, 100000)
+UPDATE_BUDGET = 0.05
+IDLE_SLEEP = 0.001
+
+def generate(directory, count, width, index=0, retries=0):
+    '''Returns a workflow object of count jobs in width parallel chains'''
+    source = os.path.join(directory, 'input-%s' % index)
+    open(source, 'a').close()
+    previous = {}
+    jobs = []
+
+    for position in range(count):
+        chain = position % width
+        folder = os.path.join(directory, str(index), str(chain))
+
+        if chain not in previous and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        inputs = [previous.get(chain, source)]
+        output = os.path.join(folder, '%s.out' % position)
+        jobs.append({
+            'cmd': '/bin/true',
+            'script': None,
+            'description': 'Benchmark job %s' % position,
+            'args': [['-in', inputs[0], 0], ['-out', output, 0]],
+            'inputs': inputs,
+            'outputs': [output],
+            'options': {'retries': retries},
+        })
+        previous[chain] = output
+
+    return {'name': 'benchmark-%s' % index, 'jobs': jobs}
+
+def start(directory, queues=1, routing='load'):
+    '''
+    Starts the engine against a new database in the directory and returns
+    its work queues
+    '''
+    path = os.path.join(directory, 'workflows.db')
+    setup(path)
+
+    notifier = EventNotifier()
+    router = ExecutorRouter(WorkQueueService.name, routing=routing)
+    services = []
+
+    for index in range(queues):
+        name = WorkQueueService.name + (':%s' % index if index else '')
+        wq = WorkQueueService({
+            'project': 'benchmark-%s' % index,
+            'catalog_server': 'localhost',
+            'catalog_port': 9097,
+            'port': 0,
+            'log': os.devnull,
+            'debug': '',
+        }, notifier, name=name)
+        router.add(wq, group=WorkQueueService.name)
+        ServiceManager.register(wq)
+        services.append(wq)
+
+    ServiceManager.start()
+    WorkflowManager.connect(path)
+    WorkflowManager.set_notifier(notifier)
+
+    notifier.register(TASK_DONE, WorkflowManager.update)
+    notifier.register(CANCEL_TASK, router.cancel)
+    notifier.register(SCHEDULE_TASK, router.schedule)
+    notifier.register(INPUTS_MISSING, WorkflowManager.requeue)
+    return services
+
+def percentile(values, fraction):
+    '''Returns the value at the fraction of the sorted values'''
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def store_calls():
+    '''Returns the number of store calls made by operation'''
+    return dict((labels['operation'], value['count'])
+                for (labels, value) in STORE_SECONDS.snapshot())
+
+def run(args, count):
+    '''Runs the workflows of count jobs and returns the measurements'''
+    work_queue.configure(workers=args.workers, latency=args.latency,
+                         jitter=args.jitter, failure_rate=args.failure_rate,
+                         seed=args.seed)
+    WorkflowManager.retry_delay = args.retry_delay
+    directory = tempfile.mkdtemp(prefix='yerba-benchmark-')
+
+    try:
+        services = start(directory, args.queues, args.routing)
+        per_workflow = max(1, count // args.workflows)
+        objects = [generate(directory, per_workflow, args.width, index,
+                            args.retries)
+                   for index in range(args.workflows)]
+        workflows = []
+        submits = []
+        began = time()
+
+        for data in objects:
+            submitted = time()
+            (workflow_id, status, errors) = WorkflowManager.submit(data)
+            submits.append(time() - submitted)
+
+            if status == Status.Error:
+                raise SystemExit("the workflow was not valid: %s" % errors)
+
+            workflows.append(WorkflowManager.workflows[workflow_id])
+
+        written = 0
+        deadline = began + args.timeout
+        timed_out = False
+
+        while any(workflow.status not in DONE_STATUS
+                  for workflow in workflows):
+            busy = ServiceManager.update(UPDATE_BUDGET)
+            WorkflowManager.retry()
+            written += WorkflowManager.store.flush()
+            WorkflowManager.evict()
+
+            if time() >= deadline:
+                timed_out = True
+                break
+
+            if not busy:
+                sleep(IDLE_SLEEP)
+
+        elapsed = time() - began
+        written += WorkflowManager.store.flush(force=True)
+        completed = sum(1 for workflow in workflows
+                        for job in workflow.jobs if job.status == 'completed')
+        turnarounds = [turnaround for wq in services
+                       for turnaround in wq.queue.turnarounds]
+        waits = DISPATCH_WAIT_SECONDS.snapshot()
+        (wait_count, wait_sum) = (0, 0.0)
+
+        for (_, value) in waits:
+            wait_count += value['count']
+            wait_sum += value['sum']
+
+        ServiceManager.stop()
+        WorkflowManager.database.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        'jobs': per_workflow * args.workflows,
+        'workflows': args.workflows,
+        'completed': completed,
+        'failed': sum(1 for workflow in workflows
+                      if workflow.status == Status.Failed),
+        'timed_out': timed_out,
+        'elapsed': elapsed,
+        'submit_mean': sum(submits) / len(submits),
+        'submit_max': max(submits),
+        'throughput': completed / elapsed if elapsed else 0.0,
+        'next_median': percentile(turnarounds, 0.5),
+        'next_p95': percentile(turnarounds, 0.95),
+        'dispatch_wait_mean': wait_sum / wait_count if wait_count else 0.0,
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'rows_written': written,
+        'store_calls': store_calls(),
+    }
+
+def report(results):
+    '''Prints the measurements as a table'''
+    print("%8s %9s %9s %10s %10s %10s %9s %9s  %s" % (
+        'jobs', 'completed', 'submit', 'jobs/s', 'next p50', 'next p95',
+        'peak rss', 'rows', 'store calls'))
+
+    for result in results:
+        calls = ' '.join('%s=%s' % item
+                         for item in sorted(result['store_calls'].items()))
+        status = ' (timed out)' if result['timed_out'] else ''
+
+        if result['failed']:
+            status += ' (%s workflows failed)' % result['failed']
+        print("%8d %9d %8.3fs %10.0f %8.2fms %8.2fms %7.1fMB %9d  %s%s" % (
+            result['jobs'], result['completed'], result['submit_mean'],
+            result['throughput'], result['next_median'] * 1000,
+            result['next_p95'] * 1000, result['peak_rss'] / 1024 / 1024,
+            result['rows_written'], calls, status))
+
+def child_args(args, count):
+    '''Returns the command line running a single size in a new process'''
+    return [sys.executable, os.path.abspath(__file__), '--json',
+            '--jobs', str(count), '--width', str(args.width),
+            '--workflows', str(args.workflows),
+            '--queues', str(args.queues), '--routing', args.routing,
+            '--workers', str(args.workers), '--latency', str(args.latency),
+            '--jitter', str(args.jitter),
+            '--failure-rate', str(args.failure_rate),
+            '--retries', str(args.retries),
+            '--retry-delay', str(args.retry_delay),
+            '--timeout', str(args.timeout)] + (
+            ['--seed', str(args.seed)] if args.seed is not None else [])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--jobs', type=int, nargs='+', default=list(SIZES),
+                        help="the number of jobs of each run")
+    parser.add_argument('--width', type=int, default=100,
+                        help="the number of parallel chains of jobs")
+    parser.add_argument('--workflows', type=int, default=1,
+                        help="the number of workflows sharing the jobs")
+    parser.add_argument('--queues', type=int, default=1,
+                        help="the number of work queues")
+    parser.add_argument('--routing', default='load',
+                        help="how jobs are spread over the work queues")
+    parser.add_argument('--workers', type=int, default=100,
+                        help="the number of simulated workers per queue")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="the seconds each task takes to run")
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help="the most seconds added at random to a task")
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help="the fraction of tasks that fail")
+    parser.add_argument('--retries', type=int, default=0,
+                        help="the number of times a failed job is retried")
+    parser.add_argument('--retry-delay', type=float, default=0.0,
+                        help="the seconds before the first retry of a job")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--timeout', type=float, default=3600,
+                        help="the most seconds a run may take")
+    parser.add_argument('--json', action='store_true',
+                        help="print the measurements as json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    if len(args.jobs) == 1:
+        results = [run(args, args.jobs[0])]
+    else:
+        results = [json.loads(subprocess.check_output(
+                       child_args(args, count)).decode('utf-8'))[0]
+                   for count in args.jobs]
+
+    if args.json:
+        print(json.dumps(results, sort_keys=True))
+    else:
+        report(results)
+
+if __name__ == '__main__':
+    main()
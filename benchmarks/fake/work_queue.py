@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+An in-process stand-in for the work_queue python bindings.
+
+Tasks are run by simulated workers. Each task takes the configured latency
+and fails with the configured probability, when its command contains one
+of the failing strings or when it runs on a broken host. Blocked hosts are
+sent no tasks while another host is available. Successful tasks create
+their output files so that workflows see them as completed.
+"""
+from collections import deque
+import heapq
+import os
+import random
+import time
+
+WORK_QUEUE_INPUT = 0
+WORK_QUEUE_OUTPUT = 1
+WORK_QUEUE_DEFAULT_PORT = 9123
+
+#: Settings shared by every queue, see configure()
+settings = {
+    'workers': 100,
+    'latency': 0.0,
+    'jitter': 0.0,
+    'failure_rate': 0.0,
+    'failing': (),
+    'broken': (),
+    'seed': None,
+}
+
+def configure(**options):
+    '''Updates the settings of the simulated workers'''
+    settings.update(options)
+
+def set_debug_flag(*flags):
+    pass
+
+class Stats(object):
+    """The statistics reported by the queue"""
+
+    def __init__(self):
+        self.start_time = time.time() * 1000000
+        self.total_send_time = 0
+        self.total_receive_time = 0
+        self.total_bytes_sent = 0
+        self.total_bytes_received = 0
+        self.total_workers_joined = settings['workers']
+        self.total_workers_removed = 0
+        self.total_tasks_complete = 0
+        self.total_tasks_dispatched = 0
+        self.tasks_waiting = 0
+        self.tasks_complete = 0
+        self.tasks_running = 0
+        self.workers_init = 0
+        self.workers_ready = settings['workers']
+        self.workers_busy = 0
+        self.workers_full = 0
+
+class Task(object):
+    def __init__(self, command):
+        self.command = command
+        self.id = None
+        self.priority = 0
+        self.outputs = []
+        self.return_status = None
+        self.hostname = None
+        self.output = ''
+        self.submit_time = 0
+        self.finish_time = 0
+        self.cmd_execution_time = 0
+
+    def specify_input_file(self, local, remote=None, flags=None, **kw):
+        pass
+
+    def specify_file(self, local, remote=None, flags=None, **kw):
+        if flags == WORK_QUEUE_OUTPUT:
+            self.outputs.append((local, False))
+
+    def specify_directory(self, local, remote=None, flags=None, **kw):
+        if flags == WORK_QUEUE_OUTPUT:
+            self.outputs.append((local, True))
+
+    def specify_priority(self, priority):
+        self.priority = priority
+
+class WorkQueue(object):
+    def __init__(self, name=None, port=WORK_QUEUE_DEFAULT_PORT, **kw):
+        self.name = name
+        self.port = WORK_QUEUE_DEFAULT_PORT
+        self.stats = Stats()
+        self.random = random.Random(settings['seed'])
+        self.ids = 0
+        #: tasks waiting for a worker
+        self.waiting = deque()
+        #: (finish time, task id, task) of the tasks being run
+        self.running = []
+        #: time each completion was returned and not yet followed by a submit
+        self.delivered = deque()
+        #: seconds from a completion being returned to the next submit
+        self.turnarounds = []
+        #: host -> time it may be sent tasks again
+        self.blocked = {}
+
+    def specify_catalog_server(self, *args):
+        pass
+
+    def specify_log(self, *args):
+        pass
+
+    def specify_password_file(self, *args):
+        pass
+
+    def hungry(self):
+        return len(self.waiting) < settings['workers']
+
+    def empty(self):
+        return not self.waiting and not self.running
+
+    def submit(self, task):
+        now = time.time()
+        self.ids += 1
+        task.id = self.ids
+        task.submit_time = now * 1000000
+        self.waiting.append(task)
+        self.stats.total_tasks_dispatched += 1
+
+        while self.delivered:
+            self.turnarounds.append(now - self.delivered.popleft())
+
+        return task.id
+
+    def wait(self, timeout=0):
+        now = time.time()
+        self._start(now)
+
+        if not self.running or self.running[0][0] > now:
+            self._update_stats()
+            return None
+
+        (_, _, task) = heapq.heappop(self.running)
+        self._finish(task, now)
+        self._start(now)
+        self.delivered.append(time.time())
+        self._update_stats()
+        return task
+
+    def cancel_by_taskid(self, taskid):
+        for task in list(self.waiting):
+            if task.id == taskid:
+                self.waiting.remove(task)
+                return task
+
+        for entry in list(self.running):
+            if entry[1] == taskid:
+                self.running.remove(entry)
+                heapq.heapify(self.running)
+                return entry[2]
+
+        return None
+
+    def shutdown_workers(self, count):
+        pass
+
+    def blacklist_with_timeout(self, host, timeout):
+        self.blocked[host] = time.time() + timeout
+
+    def _start(self, now):
+        '''Hands waiting tasks to idle workers'''
+        while self.waiting and len(self.running) < settings['workers']:
+            task = self.waiting.popleft()
+            latency = settings['latency']
+
+            if settings['jitter']:
+                latency += self.random.uniform(0, settings['jitter'])
+
+            task.hostname = self._host(task.id, now)
+            heapq.heappush(self.running, (now + latency, task.id, task))
+
+    def _host(self, taskid, now):
+        '''Returns the host running the task, avoiding blocked hosts'''
+        workers = settings['workers']
+
+        for offset in range(workers):
+            host = 'worker-%s' % ((taskid + offset) % workers)
+
+            if self.blocked.get(host, 0) <= now:
+                return host
+
+        return 'worker-%s' % (taskid % workers)
+
+    def _finish(self, task, now):
+        '''Sets the result of the task and creates its outputs'''
+        failed = (self.random.random() < settings['failure_rate'] or
+                  any(word in task.command for word in settings['failing']) or
+                  task.hostname in settings['broken'])
+        task.return_status = 1 if failed else 0
+        task.finish_time = now * 1000000
+        task.cmd_execution_time = now * 1000000 - task.submit_time
+        task.output = 'failed' if failed else ''
+
+        if failed:
+            return
+
+        for (path, directory) in task.outputs:
+            if directory:
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+            else:
+                open(path, 'a').close()
+
+        self.stats.total_tasks_complete += 1
+
+    def _update_stats(self):
+        self.stats.tasks_waiting = len(self.waiting)
+        self.stats.tasks_running = len(self.running)
+        self.stats.workers_busy = len(self.running)
+        self.stats.workers_ready = settings['workers'] - len(self.running)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Reports the memory held by each job of a large synthetic workflow.
+
+The workflow is a chain of jobs where the outputs of a job are the inputs
+of the next one, the shape of the largest workflows submitted to yerba.
+The deep size counts every object reachable from the jobs once, so
+objects shared between jobs are not counted twice.
+
+    python benchmarks/job_memory.py --jobs 100000
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+
+from yerba.workflow import Workflow
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+def rss():
+    '''Returns the resident memory of the process in bytes'''
+    with open('/proc/self/statm') as fp:
+        return int(fp.read().split()[1]) * PAGE_SIZE
+
+def generate(count):
+    '''Returns a workflow object with a chain of count jobs'''
+    jobs = []
+    previous = '/storage/data/input.fasta'
+
+    for index in range(count):
+        output = '/storage/data/%s/output-%s.bed' % (index % 100, index)
+        jobs.append({
+            'cmd': '/usr/bin/perl',
+            'script': None,
+            'description': 'Processing part %s...' % index,
+            'args': [['-in', previous, 0], ['-out', output, 0],
+                     ['-threads', 4, 0]],
+            'inputs': [previous, ['/storage/data/reference', 1]],
+            'outputs': [output],
+            'options': {'allow-zero-length': False}
+        })
+        previous = output
+
+    return {'name': 'benchmark', 'jobs': jobs}
+
+def _attributes(obj):
+    '''Returns the attribute values of the object'''
+    if hasattr(obj, '__dict__'):
+        yield obj.__dict__
+
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if hasattr(obj, name):
+                yield getattr(obj, name)
+
+def deep_size(roots):
+    '''Returns the bytes held by the objects reachable from the roots'''
+    seen = set()
+    stack = list(roots)
+    size = 0
+
+    while stack:
+        obj = stack.pop()
+
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif not isinstance(obj, (str, bytes, int, float, type(u''))):
+            stack.extend(_attributes(obj))
+
+    return size
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--jobs', type=int, default=100000)
+    args = parser.parse_args()
+
+    data = generate(args.jobs)
+    gc.collect()
+    before = rss()
+
+    workflow = Workflow.from_object(data)
+    gc.collect()
+    after = rss()
+
+    jobs = workflow.jobs
+    print("jobs:              %s" % len(jobs))
+    print("deep bytes/job:    %.0f" % (deep_size(jobs) / float(len(jobs))))
+    print("workflow rss/job:  %.0f" % ((after - before) / float(len(jobs))))
+
+if __name__ == '__main__':
+    main()
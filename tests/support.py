@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the job engine in-process for the tests.
+
+The engine is started against a new database in a temporary directory and
+the in-process work_queue of benchmarks/fake, whose simulated workers
+complete each task after the configured latency.
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from time import sleep, time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+#: The fake work_queue must shadow the real bindings
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks', 'fake'))
+sys.path.insert(1, ROOT)
+
+import work_queue
+
+from yerba.cache import WorkflowCache
+from yerba.core import (EventNotifier, DONE_STATUS, TASK_DONE, CANCEL_TASK,
+                        SCHEDULE_TASK, INPUTS_MISSING)
+from yerba.db import setup
+from yerba.fs import stat_cache
+from yerba.managers import ServiceManager, WorkflowManager
+from yerba.services import ExecutorRouter
+from yerba.spill import output_store
+from yerba.workqueue import WorkQueueService
+
+logging.getLogger('yerba').addHandler(logging.NullHandler())
+
+TIMEOUT = 5
+IDLE_SLEEP = 0.001
+
+def chain(directory, count, name='chain', source=None):
+    '''Returns a workflow object of count jobs each using the previous one'''
+    if source is None:
+        source = os.path.join(directory, '%s.in' % name)
+        open(source, 'a').close()
+
+    jobs = []
+    previous = source
+
+    for position in range(count):
+        output = os.path.join(directory, '%s-%s.out' % (name, position))
+        jobs.append(job(previous, output, '%s %s' % (name, position)))
+        previous = output
+
+    return {'name': name, 'jobs': jobs}
+
+def fan(directory, count, name='fan'):
+    '''Returns a workflow object of count jobs using the same input'''
+    source = os.path.join(directory, '%s.in' % name)
+    open(source, 'a').close()
+
+    return {'name': name, 'jobs': [
+        job(source, os.path.join(directory, '%s-%s.out' % (name, position)),
+            '%s %s' % (name, position))
+        for position in range(count)]}
+
+def job(source, output, description, **options):
+    '''Returns a job object reading the source and writing the output'''
+    return {
+        'cmd': '/bin/true',
+        'script': None,
+        'description': description,
+        'args': [['-in', source, 0], ['-out', output, 0]],
+        'inputs': [source],
+        'outputs': [output],
+        'options': options,
+    }
+
+class EngineTestCase(unittest.TestCase):
+    """
+    Starts the engine before each test and stops it afterwards.
+
+    The settings of the simulated workers are given by the workers and
+    latency attributes, every queue of the router is a WorkQueueService.
+    """
+    workers = 100
+    latency = 0.0
+    queues = 1
+    routing = 'load'
+    #: Options added to the workqueue section of every queue
+    config = {}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='yerba-test-')
+        self.path = os.path.join(self.directory, 'workflows.db')
+        setup(self.path)
+
+        work_queue.configure(workers=self.workers, latency=self.latency,
+                             jitter=0.0, failure_rate=0.0, failing=(),
+                             broken=(), seed=1)
+        stat_cache.configure(ttl=0)
+        output_store.configure(path=os.path.join(self.directory, 'output'))
+        WorkflowManager.retry_delay = 0
+        WorkflowManager.max_retry_delay = 0
+        self.start()
+
+    def tearDown(self):
+        self.stop()
+        output_store.close()
+        output_store.path = None
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def start(self):
+        '''Starts the services and connects the workflow manager'''
+        ServiceManager.core = {}
+        WorkflowManager.workflows = WorkflowCache()
+        WorkflowManager.retries = []
+        WorkflowManager.retry_times = {}
+
+        self.notifier = EventNotifier()
+        self.router = ExecutorRouter(WorkQueueService.name,
+                                     routing=self.routing)
+        self.services = []
+
+        for index in range(self.queues):
+            name = WorkQueueService.name + (':%s' % index if index else '')
+            config = {
+                'project': 'test-%s' % index,
+                'catalog_server': 'localhost',
+                'catalog_port': 9097,
+                'port': 0,
+                'log': os.devnull,
+                'debug': '',
+            }
+            config.update(self.config)
+            service = WorkQueueService(config, self.notifier, name=name)
+            self.router.add(service, group=WorkQueueService.name)
+            ServiceManager.register(service)
+            self.services.append(service)
+
+        ServiceManager.start()
+        WorkflowManager.connect(self.path)
+        WorkflowManager.set_notifier(self.notifier)
+
+        self.notifier.register(TASK_DONE, WorkflowManager.update)
+        self.notifier.register(CANCEL_TASK, self.router.cancel)
+        self.notifier.register(SCHEDULE_TASK, self.router.schedule)
+        self.notifier.register(INPUTS_MISSING, WorkflowManager.requeue)
+
+    def stop(self):
+        '''
+        Stops the services and closes the database
+
+        Buffered updates that were not flushed are lost as in a crash.
+        '''
+        ServiceManager.stop()
+        ServiceManager.core = {}
+        WorkflowManager.database.close()
+
+    @property
+    def queue(self):
+        '''Returns the fake work_queue of the first service'''
+        return self.services[0].queue
+
+    def submit(self, data):
+        '''Submits the workflow object and returns the workflow id'''
+        (workflow_id, _, errors) = WorkflowManager.submit(data)
+        self.assertFalse(errors)
+        return workflow_id
+
+    def run_until(self, predicate, timeout=TIMEOUT):
+        '''Runs the engine until the predicate holds'''
+        deadline = time() + timeout
+
+        while not predicate():
+            if time() >= deadline:
+                self.fail("the engine timed out")
+
+            busy = ServiceManager.update(0.05)
+            WorkflowManager.retry()
+            WorkflowManager.flush()
+
+            if not busy:
+                sleep(IDLE_SLEEP)
+
+    def finish(self, workflow_id, timeout=TIMEOUT):
+        '''Runs the engine until the workflow is done and returns it'''
+        self.run_until(lambda: WorkflowManager.workflows[workflow_id].status
+                       in DONE_STATUS, timeout)
+        return WorkflowManager.workflows[workflow_id]
+
+    def statuses(self, workflow):
+        '''Returns the status of each job of the workflow'''
+        return [job.status for job in workflow.jobs]
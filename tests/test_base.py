@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+import subprocess
+import sys
+import unittest
+
+from tests.support import ROOT
+
+#: Imports the daemon without the fake work_queue on the path
+IMPORT_DAEMON = '''
+import sys
+import yerba.base
+sys.exit('work_queue' in sys.modules or 'yerba.workqueue' in sys.modules)
+'''
+
+class DaemonImportTest(unittest.TestCase):
+    """The daemon running jobs locally without the cctools bindings"""
+
+    def test_work_queue_is_not_imported(self):
+        returned = subprocess.call([sys.executable, '-c', IMPORT_DAEMON],
+                                   cwd=ROOT)
+        self.assertEqual(returned, 0)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from tests.support import EngineTestCase, chain, fan, work_queue
+
+from yerba.core import Status, DONE_STATUS
+from yerba.managers import WorkflowManager
+
+class DispatchTest(EngineTestCase):
+    """Jobs submitted to work_queue by the fair share dispatcher"""
+    latency = 0.01
+
+    def setUp(self):
+        EngineTestCase.setUp(self)
+        #: (task command, priority) of every task submitted
+        self.submitted = []
+        submit = self.queue.submit
+
+        def record(task):
+            self.submitted.append((task.command, task.priority))
+            return submit(task)
+
+        self.queue.submit = record
+
+    def test_priority_of_every_task(self):
+        data = chain(self.directory, 3)
+        data['priority'] = 7
+        workflow = self.finish(self.submit(data))
+
+        self.assertEqual(workflow.status, Status.Completed)
+        self.assertEqual([priority for (_, priority) in self.submitted],
+                         [7, 7, 7])
+
+    def test_priority_of_last_queued_job(self):
+        data = fan(self.directory, 3)
+        data['priority'] = 5
+        self.finish(self.submit(data))
+
+        self.assertEqual([priority for (_, priority) in self.submitted],
+                         [5, 5, 5])
+
+    def names(self):
+        """Returns the workflow name of every task submitted"""
+        return [command.split('/')[-1].split('-')[0]
+                for (command, _) in self.submitted]
+
+    def test_workflows_take_turns(self):
+        work_queue.configure(workers=2)
+        large = self.submit(fan(self.directory, 10, name='large'))
+        small = self.submit(fan(self.directory, 2, name='small'))
+        self.finish(large)
+        self.finish(small)
+
+        names = self.names()
+        self.assertEqual(names.count('small'), 2)
+        self.assertTrue(names.index('small') < 4, names)
+        self.assertTrue(len(names) - names[::-1].index('small') < 7, names)
+
+    def test_higher_priority_first(self):
+        work_queue.configure(workers=1)
+        low = fan(self.directory, 4, name='low')
+        high = fan(self.directory, 2, name='high')
+        high['priority'] = 5
+        low_id = self.submit(low)
+        high_id = self.submit(high)
+        self.finish(low_id)
+        self.finish(high_id)
+
+        self.assertEqual(self.names(),
+                         ['low', 'high', 'high', 'low', 'low', 'low'])
+
+    def test_task_limit(self):
+        data = fan(self.directory, 6)
+        data['max_tasks'] = 2
+        workflow_id = self.submit(data)
+        workflow = WorkflowManager.workflows[workflow_id]
+        peak = []
+
+        def done():
+            peak.append(self.services[0].task_count(workflow_id))
+            return workflow.status in DONE_STATUS
+
+        self.run_until(done)
+
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(len(self.submitted), 6)
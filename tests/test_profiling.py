@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+#: Sets up the path and the logging of the tests
+import tests.support
+
+from yerba.profiling import Profiler
+
+class ProfilerTest(unittest.TestCase):
+    """Writing the stats of a profile"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='yerba-test-')
+        self.profiler = Profiler(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_file_of_the_directory(self):
+        self.assertEqual(self.profiler.resolve('daemon.prof'),
+                         os.path.join(self.directory, 'daemon.prof'))
+
+    def test_rejects_other_paths(self):
+        for name in ('/etc/passwd', '../daemon.prof', 'stats/daemon.prof',
+                     '..', '.', ''):
+            self.assertEqual(self.profiler.resolve(name), None, name)
+
+    def test_disabled_without_directory(self):
+        self.assertEqual(Profiler().resolve('daemon.prof'), None)
+
+    def test_stats_are_written(self):
+        path = self.profiler.resolve('daemon.stacks')
+        self.assertTrue(self.profiler.start(mode='sample', seconds=1,
+                                            path=path))
+        self.profiler.stop()
+
+        self.assertTrue(os.path.exists(path))
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from tests.support import EngineTestCase, chain, work_queue
+
+from yerba.core import Status
+from yerba.managers import WorkflowManager
+
+class RecoveryTest(EngineTestCase):
+    """Workflows resumed after the daemon stopped while they ran"""
+    latency = 0.02
+
+    def crash(self, workflow_id, completed):
+        '''Stops the engine once the workflow completed some jobs'''
+        workflow = WorkflowManager.workflows[workflow_id]
+        self.run_until(lambda: self.statuses(workflow).count('completed')
+                       >= completed)
+        WorkflowManager.flush(force=True)
+        self.stop()
+        self.start()
+
+    def test_finished_jobs_are_not_run_again(self):
+        workflow_id = self.submit(chain(self.directory, 4))
+        self.crash(workflow_id, 2)
+
+        WorkflowManager.recover()
+        workflow = self.finish(workflow_id)
+
+        self.assertEqual(workflow.status, Status.Completed)
+        self.assertEqual(self.statuses(workflow), ['completed'] * 4)
+        self.assertEqual(self.queue.ids, 2)
+
+    def test_attempts_are_kept(self):
+        WorkflowManager.retry_delay = WorkflowManager.max_retry_delay = 0.05
+        data = chain(self.directory, 2)
+        data['jobs'][1]['options'] = {'retries': 1}
+        work_queue.configure(failing=('chain-1',))
+        workflow_id = self.submit(data)
+        workflow = WorkflowManager.workflows[workflow_id]
+
+        self.run_until(lambda: workflow.jobs[1].status == 'retrying')
+        WorkflowManager.flush(force=True)
+        self.stop()
+        self.start()
+
+        WorkflowManager.recover()
+        workflow = self.finish(workflow_id)
+
+        self.assertEqual(workflow.status, Status.Failed)
+        self.assertEqual(workflow.jobs[1].attempts, 2)
+        self.assertEqual(self.queue.ids, 1)
+
+    def test_stopped_without_recovery(self):
+        workflow_id = self.submit(chain(self.directory, 3))
+        self.crash(workflow_id, 1)
+
+        WorkflowManager.cleanup()
+        WorkflowManager.flush(force=True)
+
+        (status, _, _) = WorkflowManager.status(workflow_id)
+        self.assertEqual(status, Status.Stopped)
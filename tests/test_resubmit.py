@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import os
+
+from tests.support import EngineTestCase, fan, job, work_queue
+
+from yerba.core import Status
+from yerba.managers import WorkflowManager
+
+class RestartTest(EngineTestCase):
+    """Workflows reloaded while their tasks are still running"""
+    latency = 0.05
+
+    def test_restart_while_running(self):
+        workflow_id = self.submit(fan(self.directory, 4))
+        self.assertEqual(len(self.queue.waiting), 4)
+
+        WorkflowManager.restart(workflow_id)
+        workflow = self.finish(workflow_id)
+
+        self.assertEqual(workflow.status, Status.Completed)
+        self.assertEqual(self.statuses(workflow), ['completed'] * 4)
+        self.assertEqual(self.queue.ids, 4)
+
+    def test_resubmit_failed_while_running(self):
+        work_queue.configure(workers=1, failing=('flaky',))
+        source = os.path.join(self.directory, 'fan.in')
+        open(source, 'a').close()
+        data = {'name': 'fan', 'jobs': [
+            job(source, os.path.join(self.directory, 'flaky.out'), 'flaky'),
+            job(source, os.path.join(self.directory, 'slow.out'), 'slow')]}
+
+        workflow_id = self.submit(data)
+        self.finish(workflow_id)
+        self.assertEqual(WorkflowManager.workflows[workflow_id].status,
+                         Status.Failed)
+        self.assertEqual(len(self.queue.waiting) + len(self.queue.running), 1)
+
+        work_queue.configure(failing=())
+        self.assertEqual(self.submit(data), workflow_id)
+        workflow = self.finish(workflow_id)
+
+        self.assertEqual(workflow.status, Status.Completed)
+        self.assertEqual(self.statuses(workflow), ['completed'] * 2)
+
+    def test_foreign_job_is_skipped(self):
+        source = os.path.join(self.directory, 'other.in')
+        open(source, 'a').close()
+        workflow_id = self.submit(fan(self.directory, 1))
+        workflow = WorkflowManager.workflows[workflow_id]
+        other = WorkflowManager.workflows[self.submit(
+            {'name': 'other', 'jobs': [
+                job(source, os.path.join(self.directory, 'other.out'),
+                    'other')]})]
+
+        WorkflowManager.update(workflow_id, [(other.jobs[0], {
+            'returned': 0, 'output': '', 'cmd': ''})])
+        workflow = self.finish(workflow_id)
+
+        self.assertEqual(workflow.status, Status.Completed)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+
+from tests.support import EngineTestCase, fan, job, work_queue
+
+from yerba.core import Status
+from yerba.managers import WorkflowManager
+
+class Records(logging.Handler):
+    """Keeps the records logged"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+class RetryTest(EngineTestCase):
+    """Failed jobs run again until they are out of retries"""
+
+    def flaky(self, retries):
+        source = os.path.join(self.directory, 'flaky.in')
+        open(source, 'a').close()
+        return {'name': 'flaky', 'jobs': [
+            job(source, os.path.join(self.directory, 'flaky.out'), 'flaky',
+                retries=retries)]}
+
+    def test_retry_completes(self):
+        WorkflowManager.retry_delay = WorkflowManager.max_retry_delay = 0.05
+        work_queue.configure(failing=('flaky',))
+        workflow_id = self.submit(self.flaky(retries=1))
+        workflow = WorkflowManager.workflows[workflow_id]
+
+        self.run_until(lambda: workflow.jobs[0].status == 'retrying')
+        work_queue.configure(failing=())
+        self.finish(workflow_id)
+
+        self.assertEqual(workflow.status, Status.Completed)
+        self.assertEqual(workflow.jobs[0].attempts, 2)
+        self.assertEqual(self.queue.ids, 2)
+
+    def test_out_of_retries(self):
+        work_queue.configure(failing=('flaky',))
+        workflow = self.finish(self.submit(self.flaky(retries=2)))
+
+        self.assertEqual(workflow.status, Status.Failed)
+        self.assertEqual(self.statuses(workflow), ['failed'])
+        self.assertEqual(workflow.jobs[0].attempts, 3)
+        self.assertEqual(self.queue.ids, 3)
+
+class BrokenWorkerTest(EngineTestCase):
+    """Retries of jobs that failed on a broken worker"""
+    workers = 2
+    config = {'failed-worker-limit': 1}
+
+    def data(self):
+        data = fan(self.directory, 4)
+
+        for item in data['jobs']:
+            item['options'] = {'retries': 1}
+
+        return data
+
+    def test_retry_avoids_blocked_worker(self):
+        work_queue.configure(broken=('worker-1',))
+        workflow = self.finish(self.submit(self.data()))
+
+        self.assertEqual(workflow.status, Status.Completed)
+        self.assertIn('worker-1', self.queue.blocked)
+
+    def test_warns_without_blocking(self):
+        records = Records()
+        logger = logging.getLogger('yerba.workqueue')
+        logger.addHandler(records)
+        self.addCleanup(logger.removeHandler, records)
+        self.queue.blacklist_with_timeout = None
+
+        work_queue.configure(broken=('worker-1',))
+        workflow = self.finish(self.submit(self.data()))
+
+        self.assertEqual(workflow.status, Status.Failed)
+        self.assertTrue([record for record in records.records
+                         if record.levelno == logging.WARNING and
+                         'can not block' in record.getMessage()])
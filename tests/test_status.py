@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from tests.support import EngineTestCase, chain
+
+from yerba.core import Status
+from yerba.managers import WorkflowManager
+
+class SinceTest(EngineTestCase):
+    """Status requests only returning the jobs changed after a cursor"""
+    latency = 0.02
+
+    def test_every_job_without_cursor(self):
+        workflow_id = self.submit(chain(self.directory, 3))
+        (status, jobs, cursor) = WorkflowManager.status(workflow_id)
+
+        self.assertEqual(status, Status.Running)
+        self.assertEqual([job['status'] for job in jobs],
+                         ['running', 'scheduled', 'scheduled'])
+        self.assertTrue(cursor is not None)
+
+    def test_changed_jobs(self):
+        workflow_id = self.submit(chain(self.directory, 3))
+        (_, _, cursor) = WorkflowManager.status(workflow_id)
+        workflow = WorkflowManager.workflows[workflow_id]
+
+        self.run_until(lambda: workflow.jobs[1].status == 'running')
+        (_, jobs, latest) = WorkflowManager.status(workflow_id, since=cursor)
+
+        self.assertEqual([(job['position'], job['status']) for job in jobs],
+                         [(0, 'completed'), (1, 'running')])
+        self.assertTrue(latest > cursor)
+        self.assertEqual(WorkflowManager.status(workflow_id, since=latest)[1],
+                         [])
+
+    def test_cursor_before_workflow(self):
+        workflow_id = self.submit(chain(self.directory, 3))
+        jobs = WorkflowManager.status(workflow_id, since=0)[1]
+
+        self.assertEqual([job['position'] for job in jobs], [0, 1, 2])
+
+    def test_cursor_of_evicted_workflow(self):
+        workflow_id = self.submit(chain(self.directory, 2))
+        (_, _, cursor) = WorkflowManager.status(workflow_id)
+        self.finish(workflow_id)
+        WorkflowManager.flush(force=True)
+        WorkflowManager.workflows.clear()
+        (status, jobs, _) = WorkflowManager.status(workflow_id, since=cursor)
+
+        self.assertEqual(status, Status.Completed)
+        self.assertEqual([job['status'] for job in jobs],
+                         ['completed', 'completed'])
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+#: Sets up the path and the logging of the tests
+import tests.support
+
+from yerba.core import Status
+from yerba.db import Database, WorkflowStore, setup, upgrade, PAGE_SIZE
+
+class StoreTestCase(unittest.TestCase):
+    """Opens a store on a new database"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='yerba-test-')
+        self.path = os.path.join(self.directory, 'workflows.db')
+        setup(self.path)
+        self.database = Database()
+        self.database.connect(self.path)
+        self.store = WorkflowStore(self.database)
+
+    def tearDown(self):
+        self.database.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+class PagingTest(StoreTestCase):
+    """Listing the workflows a page at a time"""
+
+    def add(self, count, **fields):
+        return [self.store.add_workflow(**fields) for _ in range(count)]
+
+    def ids(self, rows):
+        return [row[0] for row in rows]
+
+    def test_default_page_is_bounded(self):
+        added = self.add(PAGE_SIZE + 5)
+        (rows, cursor) = self.store.fetch()
+
+        self.assertEqual(self.ids(rows), added[:PAGE_SIZE])
+        self.assertEqual(cursor, added[PAGE_SIZE - 1])
+
+        (rows, cursor) = self.store.fetch(cursor=cursor)
+
+        self.assertEqual(self.ids(rows), added[PAGE_SIZE:])
+        self.assertEqual(cursor, None)
+
+    def test_follow_cursor(self):
+        added = self.add(7)
+        (listed, cursor) = ([], None)
+
+        while True:
+            (rows, cursor) = self.store.fetch(cursor=cursor, limit=3)
+            listed.extend(self.ids(rows))
+
+            if cursor is None:
+                break
+
+        self.assertEqual(listed, added)
+
+    def test_ids_are_paged(self):
+        added = self.add(5)
+        (rows, cursor) = self.store.fetch(ids=added[::-1], limit=2)
+
+        self.assertEqual(self.ids(rows), added[:2])
+        self.assertEqual(self.ids(self.store.fetch(ids=added, cursor=cursor,
+                                                   limit=10)[0]), added[2:])
+
+    def test_filters(self):
+        running = self.add(2, name='align', status=Status.Running)
+        self.add(2, name='index', status=Status.Running)
+        self.add(1, name='align', status=Status.Completed)
+
+        (rows, _) = self.store.fetch(status='running', name='al')
+
+        self.assertEqual(self.ids(rows), running)
+
+    def test_submission_range(self):
+        added = self.add(3)
+        times = [float(row[2]) for row in self.store.fetch()[0]]
+
+        (rows, _) = self.store.fetch(since=times[1], until=times[2] + 1)
+
+        self.assertEqual(self.ids(rows), added[1:])
+
+    def test_listing_does_not_flush(self):
+        (workflow_id,) = self.add(1, status=Status.Running)
+        self.store.update_status(workflow_id, Status.Completed)
+
+        self.assertEqual(self.store.fetch()[0][0][4], Status.Running)
+
+        self.store.flush(force=True)
+        self.assertEqual(self.store.fetch()[0][0][4], Status.Completed)
+
+class Handle(object):
+    """A connection of an SQLite without indexes on expressions"""
+
+    def __init__(self, handle):
+        self.handle = handle
+
+    def __enter__(self):
+        return self.handle.__enter__()
+
+    def __exit__(self, *args):
+        return self.handle.__exit__(*args)
+
+    def execute(self, query, params=()):
+        if 'CAST' in query and 'CREATE INDEX' in query:
+            raise sqlite3.OperationalError("syntax error")
+
+        return self.handle.execute(query, params)
+
+class UpgradeTest(StoreTestCase):
+    """Upgrading the schema of existing databases"""
+
+    def indexes(self):
+        return set(row[0] for row in self.database.handle.execute(
+            "SELECT name FROM sqlite_master WHERE type='index'"))
+
+    def test_submitted_time_index(self):
+        self.assertIn('workflows_submitted_time', self.indexes())
+        self.assertNotIn('workflows_submitted', self.indexes())
+
+    def test_index_without_expressions(self):
+        self.database.handle.execute('DROP INDEX workflows_submitted_time')
+        upgrade(Handle(self.database.handle))
+
+        self.assertIn('workflows_submitted', self.indexes())
+        self.assertNotIn('workflows_submitted_time', self.indexes())
@@ -2,104 +2,432 @@
 import atexit
 import json
 import logging
+import os
+import threading
 from pprint import pformat
-from time import sleep
+from sys import exit
+from time import time
 
 import zmq
 from yerba.core import (status_message, status_name, EventNotifier,
-                        SCHEDULE_TASK, CANCEL_TASK, TASK_DONE)
+                        SCHEDULE_TASK, CANCEL_TASK, TASK_DONE, WATCH_INPUTS,
+                        INPUTS_READY, INPUTS_MISSING, WORKFLOW_CHANGED)
+from yerba.fs import stat_cache
+from yerba.local import LocalExecutorService
+from yerba.logwriter import log_writer
+from yerba import metrics
+from yerba import profiling
 from yerba.managers import (ServiceManager, WorkflowManager)
-from yerba.routes import (route, dispatch)
+from yerba.publisher import EventPublisher
+from yerba.spill import output_store
+from yerba.routes import (route, dispatch, is_readonly, BATCH_ROUTE,
+                          RouteNotFound)
+from yerba.services import ExecutorRouter, ROUTING, WORKQUEUE
+from yerba.watcher import InputWatcher
 from yerba.workflow import WorkflowError
-from yerba.workqueue import WorkQueueService
 
 logger = logging.getLogger('yerba')
 access = logging.getLogger('access')
 running = True
+#: Set once the daemon has been torn down
+stopped = False
 decoder = json.JSONDecoder()
 
+WORKERS_ADDRESS = "inproc://yerba-workers"
+WORKER_JOIN_TIMEOUT = 5
+WORKFLOW_FILTERS = ('ids', 'status', 'name', 'since', 'until', 'cursor', 'limit')
+
 def listen_forever(config):
+    stat_cache.configure(ttl=config.getfloat('yerba', 'stat-ttl'),
+                         threads=config.getint('yerba', 'stat-threads'))
+    log_writer.configure(
+        interval=config.getfloat('yerba', 'log-flush-interval'),
+        max_buffer=config.getint('yerba', 'log-buffer') * 1024,
+        max_handles=config.getint('yerba', 'log-handles'))
+
     notifier = EventNotifier()
-    wq = WorkQueueService(dict(config.items('workqueue')), notifier)
-    ServiceManager.register(wq)
+
+    #: Jobs run on the default executor unless they are routed elsewhere
+    executor = config.get('yerba', 'executor')
+    routing = config.get('yerba', 'routing')
+
+    if executor not in (WORKQUEUE, LocalExecutorService.name):
+        logger.error("Unknown executor %s", executor)
+        exit(1)
+
+    if routing not in ROUTING:
+        logger.error("Unknown routing %s", routing)
+        exit(1)
+
+    router = ExecutorRouter(executor, routing=routing)
+
+    #: Each workqueue section runs its own work_queue master
+    if router.default == WORKQUEUE:
+        for wq in workqueue_services(config, notifier):
+            router.add(wq, group=WORKQUEUE)
+            ServiceManager.register(wq)
+
+    if (router.default == LocalExecutorService.name or
+            config.has_section('local')):
+        local_config = {}
+
+        if config.has_section('local'):
+            local_config = dict(config.items('local'))
+
+        local = LocalExecutorService(local_config, notifier)
+        router.add(local, commands=local.commands)
+        ServiceManager.register(local)
+
+    watcher_config = {}
+
+    if config.has_section('watcher'):
+        watcher_config = dict(config.items('watcher'))
+
+    watcher = InputWatcher(watcher_config, notifier)
+    ServiceManager.register(watcher)
     ServiceManager.start()
-    WorkflowManager.connect(config.get('db', 'path'))
+    WorkflowManager.connect(config.get('db', 'path'),
+        journal_mode=config.get('db', 'journal-mode'),
+        synchronous=config.get('db', 'synchronous'),
+        flush_interval=config.getfloat('db', 'flush-interval'),
+        max_pending=config.getint('db', 'max-pending'))
+    #: Task output is kept next to the database unless configured
+    if config.has_option('db', 'output-dir'):
+        output_store.configure(path=config.get('db', 'output-dir'))
+    else:
+        output_store.configure(
+            path=os.path.splitext(config.get('db', 'path'))[0] + '-output')
+
+    WorkflowManager.workflows.configure(
+        max_size=config.getint('yerba', 'cache-size'),
+        ttl=config.getfloat('yerba', 'cache-ttl'),
+        max_memory=config.getint('yerba', 'cache-memory') * 1024 * 1024)
     WorkflowManager.set_notifier(notifier)
-    WorkflowManager.cleanup()
+    WorkflowManager.input_timeout = float(watcher_config.get('timeout', 0))
+    WorkflowManager.retry_delay = config.getfloat('yerba', 'retry-delay')
+    WorkflowManager.max_retry_delay = config.getfloat('yerba',
+                                                      'retry-max-delay')
 
     #: Register for events to be notified by
     notifier.register(TASK_DONE, WorkflowManager.update)
-    notifier.register(CANCEL_TASK, wq.cancel)
-    notifier.register(SCHEDULE_TASK, wq.schedule)
+    notifier.register(CANCEL_TASK, router.cancel)
+    notifier.register(CANCEL_TASK, watcher.unwatch)
+    notifier.register(SCHEDULE_TASK, router.schedule)
+    notifier.register(WATCH_INPUTS, watcher.watch)
+    notifier.register(INPUTS_READY, WorkflowManager.wake)
+    notifier.register(INPUTS_MISSING, WorkflowManager.requeue)
 
-    connection_string = "tcp://*:{}".format(config.get('yerba', 'port'))
     context = zmq.Context()
-    socket = context.socket(zmq.REP)
-    socket.set(zmq.LINGER, 0)
-    socket.bind(connection_string)
+    sockets = []
+
+    profiling.slow_span = config.getint('yerba', 'slow-span') / 1000.0
+    profiling.profiler.directory = config.get('yerba', 'profile-dir') or None
+
+    #: Expose the metrics over http for scrapers
+    if config.getint('yerba', 'metrics-port'):
+        metrics.serve(config.getint('yerba', 'metrics-port'))
+
+    #: Publish workflow and job changes to subscribers
+    if config.getint('yerba', 'publish-port'):
+        publisher = EventPublisher(context, "tcp://*:{}".format(
+            config.get('yerba', 'publish-port')))
+        notifier.register(WORKFLOW_CHANGED, publisher.publish)
+        sockets.append(publisher.socket)
+
+    #: Resume the workflows that were running or mark them as stopped
+    if config.getboolean('db', 'recover'):
+        WorkflowManager.recover()
+    else:
+        WorkflowManager.cleanup()
+
+    connection_string = "tcp://*:{}".format(config.get('yerba', 'port'))
+    frontend = context.socket(zmq.ROUTER)
+    frontend.set(zmq.LINGER, 0)
+    frontend.bind(connection_string)
+
+    #: Read-only requests are handed to a pool of worker threads
+    backend = context.socket(zmq.DEALER)
+    backend.set(zmq.LINGER, 0)
+    backend.bind(WORKERS_ADDRESS)
+    sockets.extend((frontend, backend))
+
+    workers = [RequestWorker(context, index)
+               for index in range(config.getint('yerba', 'workers'))]
+
+    for worker in workers:
+        worker.start()
+
     poller = zmq.Poller()
-    poller.register(socket, zmq.POLLIN)
-    atexit.register(shutdown)
+    poller.register(frontend, zmq.POLLIN)
+    poller.register(backend, zmq.POLLIN)
+    atexit.register(teardown, context, sockets, workers)
+
+    #: Time budgets for each side of the loop (milliseconds)
+    poll_timeout = config.getint('yerba', 'poll-timeout')
+    request_budget = config.getint('yerba', 'request-budget') / 1000.0
+    update_budget = config.getint('yerba', 'update-budget') / 1000.0
+
+    busy = False
 
     while running:
         try:
-            if socket in dict(poller.poll(timeout=10)):
-                msg = None
-                response = None
-
-                try:
-                    data = socket.recv_string()
-                    msg = decoder.decode(data)
-                    access.debug("ZMQ: Recieved \n%s", pformat(msg))
-                except Exception:
-                    logger.exception("ZMQ: The message was not parsed")
-
-                if not msg:
-                    logger.warn("The message was not recieved.")
-                else:
-                    try:
-                        response = dispatch(msg)
-                    except:
-                        logger.exception("EXCEPTION")
-
-                if not response:
-                    logger.info("Invalid request")
-                    response = {"status" : "Failed", "error": "Invalid response"}
-
-                try:
-                    message = json.dumps(response, encoding="utf-8", ensure_ascii=False)
-                except Exception:
-                    message = json.dumps({"status": "Failed", "error": "Invalid json"})
-                    logger.exception("INVALID JSON RESPONSE:\n %s", pformat(response))
-
-                try:
-                    access.info("Sending Response")
-                    socket.send_unicode(message, flags=zmq.NOBLOCK)
-                except zmq.Again:
-                    logger.exception("Failed to respond with response %s",
-                        response)
-                finally:
-                    access.info("Finished processing the response")
-            else:
-                try:
-                    ServiceManager.update()
-                except:
-                    logger.exception("WORKQUEUE: Update error occured")
+            #: Block on the sockets only while the services are idle
+            timeout = 0 if busy else poll_timeout
+            events = dict(poller.poll(timeout=timeout))
+
+            #: Forward responses from the workers to their clients
+            if backend in events:
+                while backend.poll(0, zmq.POLLIN):
+                    frontend.send_multipart(backend.recv_multipart())
+
+            if frontend in events:
+                deadline = time() + request_budget
+
+                #: Drain queued requests until the budget is spent
+                while True:
+                    route_request(frontend, backend)
+
+                    if time() >= deadline or not frontend.poll(0, zmq.POLLIN):
+                        break
+
+            try:
+                busy = ServiceManager.update(update_budget)
+            except:
+                busy = False
+                logger.exception("WORKQUEUE: Update error occured")
+
+            #: Run again the failed jobs whose backoff has passed
+            WorkflowManager.retry()
+
+            #: Commit the status updates made during this turn
+            WorkflowManager.flush()
+            WorkflowManager.evict()
+            profiling.profiler.tick()
         except:
             logger.exception("EXPERIENCED AN ERROR!")
 
-        # Sleep for 5 milliseconds
-        sleep(0.05)
+    teardown(context, sockets, workers)
 
+def teardown(context, sockets, workers):
+    '''
+    Stops the services and request workers, then writes and closes the store.
 
-@route("shutdown")
-def shutdown():
-    '''Shutdowns down the daemon'''
+    It is called once the main loop exits and again at exit, only the first
+    call tears the daemon down.
+    '''
+    global running, stopped
+
+    if stopped:
+        return
+
+    stopped = True
     running = False
     ServiceManager.stop()
 
+    #: Terminating the context wakes the workers blocked on their sockets
+    for socket in sockets:
+        socket.close()
+
+    context.term()
+
+    for worker in workers:
+        worker.join(WORKER_JOIN_TIMEOUT)
+
+    WorkflowManager.flush(force=True)
+    WorkflowManager.database.close()
+    log_writer.close()
+    output_store.close()
+
+def workqueue_sections(config):
+    '''
+    Returns the workqueue section followed by the named workqueue:<name>
+    sections of the config
+    '''
+    prefix = WORKQUEUE + ':'
+    named = sorted(section for section in config.sections()
+                   if section.startswith(prefix))
+    return [WORKQUEUE] + named
+
+def workqueue_services(config, notifier):
+    '''
+    Returns a work_queue service for each workqueue section
+
+    The work_queue bindings of cctools are only imported here, a daemon
+    running jobs locally does not need them.
+    '''
+    try:
+        from yerba.workqueue import WorkQueueService
+    except ImportError:
+        logger.exception("The work_queue bindings could not be imported")
+        exit(1)
+
+    return [WorkQueueService(dict(config.items(section)), notifier,
+                             name=section)
+            for section in workqueue_sections(config)]
+
+def route_request(frontend, backend):
+    '''
+    Receives a single request from the frontend.
+
+    Read-only requests are forwarded to the worker pool while all other
+    requests are handled on the scheduler thread.
+    '''
+    frames = frontend.recv_multipart()
+    (envelope, data) = (frames[:-1], frames[-1])
+    msg = decode(data)
+
+    if msg and is_readonly(msg):
+        backend.send_multipart(frames)
+        return
+
+    try:
+        access.info("Sending Response")
+        frontend.send_multipart(envelope + [respond(msg)], flags=zmq.NOBLOCK)
+    except zmq.Again:
+        logger.exception("Failed to respond to the request %s", msg)
+    finally:
+        access.info("Finished processing the response")
+
+def decode(data):
+    '''Returns the decoded request or None if it could not be parsed'''
+    msg = None
+
+    try:
+        msg = decoder.decode(data.decode('utf-8'))
+        access.debug("ZMQ: Recieved \n%s", pformat(msg))
+    except Exception:
+        logger.exception("ZMQ: The message was not parsed")
+
+    return msg
+
+def respond(msg):
+    '''Dispatches the request and returns the encoded response'''
+    response = None
+
+    if not msg:
+        logger.warn("The message was not recieved.")
+    else:
+        try:
+            response = dispatch(msg)
+        except:
+            logger.exception("EXCEPTION")
+
+    if not response:
+        logger.info("Invalid request")
+        response = {"status" : "Failed", "error": "Invalid response"}
+
+    try:
+        message = json.dumps(response, encoding="utf-8", ensure_ascii=False)
+    except Exception:
+        message = json.dumps({"status": "Failed", "error": "Invalid json"})
+        logger.exception("INVALID JSON RESPONSE:\n %s", pformat(response))
+
+    if not isinstance(message, bytes):
+        message = message.encode('utf-8')
+
+    return message
+
+class RequestWorker(threading.Thread):
+    '''Serves read-only requests forwarded by the scheduler thread'''
+
+    def __init__(self, context, index):
+        threading.Thread.__init__(self, name="yerba-worker-%s" % index)
+        self.daemon = True
+        self.context = context
+
+    def run(self):
+        socket = self.context.socket(zmq.DEALER)
+        socket.set(zmq.LINGER, 0)
+        socket.connect(WORKERS_ADDRESS)
+
+        while running:
+            try:
+                frames = socket.recv_multipart()
+                (envelope, data) = (frames[:-1], frames[-1])
+                socket.send_multipart(envelope + [respond(decode(data))])
+            except zmq.ContextTerminated:
+                break
+            except:
+                logger.exception("WORKER %s: failed to serve request",
+                                 self.name)
+
+        socket.close()
+
+
+@route("shutdown")
+def shutdown(data=None):
+    '''
+    Shutdowns down the daemon
+
+    The main loop exits after this request and tears the daemon down.
+    '''
+    global running
+    running = False
+    return {"status" : "OK"}
+
+@route("profile")
+def profile_daemon(data):
+    """
+    Starts, stops or reports a profile of the daemon.
+
+    A profile runs for at most the given number of seconds. Its stats are
+    returned by the stop and report actions and written to the file named
+    by path in the profile directory if given.
+    """
+    access.info("##### PROFILE #####")
+    data = data or {}
+    action = data.get('action', 'start')
+    profiler = profiling.profiler
+
+    if action == 'start':
+        path = None
+
+        if data.get('path'):
+            path = profiler.resolve(data['path'])
+
+            if path is None:
+                return {"status" : "Failed",
+                        "error" : "The path must name a file of the profile "
+                                  "directory"}
+
+        try:
+            started = profiler.start(mode=data.get('mode', 'profile'),
+                                     seconds=data.get('seconds', 10),
+                                     path=path)
+        except (TypeError, ValueError):
+            started = False
+
+        if not started:
+            return {"status" : "Failed",
+                    "error" : "A profile is running or the mode is invalid"}
+
+        return {"status" : "OK", "until" : profiler.deadline}
+
+    if action == 'stop':
+        profiler.stop()
+    elif action != 'report':
+        return {"status" : "Failed", "error" : "Unknown action"}
+
+    try:
+        limit = int(data.get('limit', profiling.REPORT_LIMIT))
+    except (TypeError, ValueError):
+        limit = profiling.REPORT_LIMIT
+
+    return {
+        "status" : "OK",
+        "running" : profiler.running,
+        "stats" : profiler.report(sort=data.get('sort', 'cumulative'),
+                                  limit=limit)
+    }
+
+@route("metrics", readonly=True)
+def get_metrics(data):
+    '''Returns the counters, histograms and gauges of the job engine'''
+    access.info("##### METRICS #####")
+    return {"status" : "OK", "metrics" : metrics.registry.snapshot()}
+
 #XXX: Add reporting information
-@route("health")
+@route("health", readonly=True)
 def get_health(data):
     access.info("#### HEALTH CHECK #####")
     return  {"status" : "OK" }
@@ -148,34 +476,106 @@ def cancel_workflow(data):
     except KeyError:
         return {"status" : 'NotFound'}
 
-@route("workflows")
+@route("workflows", readonly=True)
 def get_workflows(data):
-    '''Return all matching workflows'''
+    '''Return a page of matching workflows'''
     access.info("##### FETCHING WORKFLOWS #####")
-    ids = None
-    status = None
+    filters = {}
 
     if data:
-        ids = data.get('ids', [])
-        status = data.get('status', None)
+        for key in WORKFLOW_FILTERS:
+            if data.get(key) is not None:
+                filters[key] = data[key]
 
-    workflows = WorkflowManager.get_workflows(ids, status)
+    (workflows, cursor) = WorkflowManager.get_workflows(**filters)
     result = []
 
     for (workflow_id, name, start, stop, status, priority) in workflows:
         status_message = status_name(status)
         result.append((workflow_id, name, start, stop, status_message))
 
-    return { "workflows" : result }
+    return { "workflows" : result, "cursor" : cursor }
 
-@route("get_status")
+@route("get_status", readonly=True)
 def get_workflow_status(data):
     '''Gets the status of the workflow.'''
     access.info("##### WORKFLOW STATUS CHECK #####")
     try:
         identity = data['id']
-        (status, jobs) = WorkflowManager.status(identity)
+        (status, jobs, cursor) = WorkflowManager.status(identity,
+            data.get('since'), bool(data.get('output')))
         logger.info(status_message(identity, status))
-        return {"status" : status_name(status), "jobs" : jobs}
+        return status_response(status, jobs, cursor)
     except KeyError:
-        return {"status" : 'NotFound', "jobs" : {}}
+        return {"status" : 'NotFound', "jobs" : {}, "cursor" : None}
+
+def status_response(status, jobs, cursor):
+    '''Returns the response to a status check'''
+    return {"status" : status_name(status), "jobs" : jobs, "cursor" : cursor}
+
+@route(BATCH_ROUTE)
+def run_batch(data):
+    """
+    Runs a list of requests and returns their responses in order.
+
+    Consecutive status checks are answered together from a single query.
+    A request that fails is answered with an error without failing the
+    rest of the batch.
+    """
+    access.info("##### BATCH REQUEST #####")
+    requests = data.get('requests') if data else None
+
+    if not isinstance(requests, list):
+        return {"status" : "Failed", "error" : "Expected a list of requests"}
+
+    responses = []
+    checks = []
+
+    for item in requests:
+        if _is_status_check(item):
+            checks.append(item['data'])
+            continue
+
+        responses.extend(_check_statuses(checks))
+        responses.append(_run_batch_item(item))
+        checks = []
+
+    responses.extend(_check_statuses(checks))
+    return {"status" : "OK", "responses" : responses}
+
+def _check_statuses(checks):
+    '''Returns the responses to a list of status checks'''
+    if not checks:
+        return []
+
+    results = WorkflowManager.statuses(
+        [(check['id'], check.get('since'), bool(check.get('output')))
+         for check in checks])
+    return [status_response(*result) for result in results]
+
+def _is_status_check(item):
+    '''Returns whether the batch item is a well formed status check'''
+    return (isinstance(item, dict) and item.get('request') == "get_status" and
+            isinstance(item.get('data'), dict) and 'id' in item['data'])
+
+def _run_batch_item(item):
+    '''Returns the response of a batch item or the error it raised'''
+    if not isinstance(item, dict):
+        return {"status" : "Failed", "error" : "Invalid request"}
+
+    try:
+        if item['request'] == BATCH_ROUTE:
+            raise RouteNotFound("Batches can not be nested.")
+
+        response = dispatch(item)
+    except RouteNotFound:
+        return {"status" : "Failed",
+                "error" : "The request could not be routed"}
+    except Exception:
+        logger.exception("BATCH: the request failed")
+        return {"status" : "Failed", "error" : "The request failed"}
+
+    if not response:
+        return {"status" : "Failed", "error" : "Invalid response"}
+
+    return response
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from logging import getLogger
+from threading import RLock
+from time import time
+
+logger = getLogger('yerba.cache')
+
+MAX_SIZE = 1000
+TTL = 3600
+MAX_MEMORY = 512 * 1024 * 1024
+
+class WorkflowCache(object):
+    """
+    Holds the workflows known to the job engine.
+
+    Workflows that have not finished are always kept. Finished workflows
+    are evicted in least recently used order once there are more than
+    max_size of them, their jobs hold more than max_memory bytes or they
+    finished more than ttl seconds ago.
+    """
+
+    def __init__(self, max_size=MAX_SIZE, ttl=TTL, max_memory=MAX_MEMORY):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_memory = max_memory
+        self.workflows = {}
+        #: workflow id -> (finished at, footprint) in least recently used order
+        self.finished = OrderedDict()
+        self.memory = 0
+        self.lock = RLock()
+
+    def configure(self, max_size=None, ttl=None, max_memory=None):
+        '''Updates the eviction policy'''
+        if max_size is not None:
+            self.max_size = max_size
+
+        if ttl is not None:
+            self.ttl = ttl
+
+        if max_memory is not None:
+            self.max_memory = max_memory
+
+    def __getitem__(self, workflow_id):
+        with self.lock:
+            workflow = self.workflows[workflow_id]
+
+            if workflow_id in self.finished:
+                self.finished[workflow_id] = self.finished.pop(workflow_id)
+
+            return workflow
+
+    def __setitem__(self, workflow_id, workflow):
+        with self.lock:
+            self._forget(workflow_id)
+            self.workflows[workflow_id] = workflow
+
+    def __delitem__(self, workflow_id):
+        with self.lock:
+            self._forget(workflow_id)
+            del self.workflows[workflow_id]
+
+    def __contains__(self, workflow_id):
+        return workflow_id in self.workflows
+
+    def __len__(self):
+        return len(self.workflows)
+
+    def get(self, workflow_id, default=None):
+        try:
+            return self[workflow_id]
+        except KeyError:
+            return default
+
+    def items(self):
+        with self.lock:
+            return self.workflows.items()
+
+    def values(self):
+        with self.lock:
+            return self.workflows.values()
+
+    def clear(self):
+        with self.lock:
+            self.workflows.clear()
+            self.finished.clear()
+            self.memory = 0
+
+    def finish(self, workflow_id):
+        '''Marks the workflow as finished so that it can be evicted'''
+        with self.lock:
+            workflow = self.workflows.get(workflow_id)
+
+            if workflow is None or workflow_id in self.finished:
+                return
+
+            footprint = workflow.footprint()
+            self.finished[workflow_id] = (time(), footprint)
+            self.memory += footprint
+
+    def add_finished(self, workflow_id, workflow):
+        '''
+        Adds a finished workflow unless the workflow is already known.
+
+        Returns the workflow held by the cache.
+        '''
+        with self.lock:
+            if workflow_id in self.workflows:
+                return self[workflow_id]
+
+            self.workflows[workflow_id] = workflow
+            self.finish(workflow_id)
+            return workflow
+
+    def evict(self):
+        '''Evicts finished workflows and returns their ids'''
+        evicted = []
+        expired = time() - self.ttl
+
+        with self.lock:
+            for (workflow_id, (finished_at, _)) in self.finished.items():
+                if (len(self.finished) <= self.max_size and
+                        self.memory <= self.max_memory and
+                        finished_at >= expired):
+                    # Entries are ordered by use so a later entry may
+                    # still have expired
+                    continue
+
+                del self.workflows[workflow_id]
+                self._forget(workflow_id)
+                evicted.append(workflow_id)
+
+        if evicted:
+            logger.info("evicted %s finished workflows", len(evicted))
+
+        return evicted
+
+    def _forget(self, workflow_id):
+        '''Stops tracking the workflow as finished'''
+        entry = self.finished.pop(workflow_id, None)
+
+        if entry is not None:
+            self.memory -= entry[1]
@@ -42,6 +42,10 @@ def status_message(name, code):
 SCHEDULE_TASK = 'schedule'
 CANCEL_TASK = 'cancel'
 TASK_DONE = 'done'
+WATCH_INPUTS = 'watch'
+INPUTS_READY = 'ready'
+INPUTS_MISSING = 'missing'
+WORKFLOW_CHANGED = 'changed'
 
 class EventNotifier(object):
     def __init__(self):
@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
-from json import JSONEncoder
-from sqlite3 import connect, IntegrityError
+from hashlib import sha1
+from json import JSONEncoder, loads
+from logging import getLogger
+from sqlite3 import connect, sqlite_version, IntegrityError, OperationalError
+from threading import local, Lock
 from time import time
 
 from yerba.core import Status, status_code
+from yerba.metrics import timed, STORE_SECONDS
+from yerba.utils import ignored
+
+logger = getLogger('yerba.db')
 
 CREATE_TABLE_QUERY = '''
     CREATE TABLE IF NOT EXISTS workflows
@@ -14,7 +21,53 @@ CREATE_TABLE_QUERY = '''
      submitted TEXT,
      completed TEXT,
      priority INTEGER,
-     status INTEGER)
+     status INTEGER,
+     jobs_hash TEXT,
+     max_tasks INTEGER)
+'''
+
+CREATE_JOBS_HASH_INDEX_QUERY = '''
+    CREATE INDEX IF NOT EXISTS workflows_jobs_hash
+    ON workflows(jobs_hash)
+'''
+
+#: The submitted time is stored as text so it is compared as a number
+SUBMITTED_TIME = 'CAST(submitted AS REAL)'
+
+CREATE_WORKFLOW_INDEX_QUERIES = (
+    'CREATE INDEX IF NOT EXISTS workflows_status ON workflows(status, id)',
+    'CREATE INDEX IF NOT EXISTS workflows_name ON workflows(name)',
+)
+
+#: Indexes on expressions need SQLite 3.9, older versions index the column
+CREATE_SUBMITTED_TIME_INDEX_QUERY = '''
+    CREATE INDEX IF NOT EXISTS workflows_submitted_time
+    ON workflows({0})
+'''.format(SUBMITTED_TIME)
+
+CREATE_SUBMITTED_INDEX_QUERY = '''
+    CREATE INDEX IF NOT EXISTS workflows_submitted
+    ON workflows(submitted)
+'''
+
+#: Columns returned for a workflow row
+WORKFLOW_COLUMNS = ('id, name, log, jobs, submitted, completed, priority, '
+                    'status, max_tasks')
+
+CREATE_JOBS_TABLE_QUERY = '''
+    CREATE TABLE IF NOT EXISTS jobs
+    (workflow_id INTEGER,
+     position INTEGER,
+     status TEXT,
+     taskid INTEGER,
+     started TEXT,
+     ended TEXT,
+     elapsed REAL,
+     returned INTEGER,
+     attempts INTEGER,
+     output_ref TEXT,
+     output_size INTEGER,
+     PRIMARY KEY (workflow_id, position))
 '''
 
 START_INDEX_QUERY = '''
@@ -23,21 +76,84 @@ START_INDEX_QUERY = '''
     WHERE name='workflows'
 '''
 
+JOURNAL_MODE = 'WAL'
+SYNCHRONOUS = 'NORMAL'
+FLUSH_INTERVAL = 1.0
+MAX_PENDING = 1000
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 900
+
+UPDATE_STATUS_QUERY = '''
+    UPDATE workflows
+    SET status=?, completed=? WHERE id=?
+'''
+
+SAVE_JOBS_QUERY = '''
+    INSERT OR REPLACE INTO jobs(workflow_id, position, status, taskid,
+                                started, ended, elapsed, returned,
+                                attempts, output_ref, output_size)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
 encoder = JSONEncoder()
+canonical_encoder = JSONEncoder(sort_keys=True, separators=(',', ':'))
+
+def jobs_hash(jobs):
+    """
+    Returns a stable hash of the jobs document
+
+    Keys are sorted so that equal documents always have the same hash.
+    """
+    return sha1(canonical_encoder.encode(jobs).encode('utf-8')).hexdigest()
 
 class Database(object):
     """
     A minimal interface that abstract the sqlite api
+
+    Each thread is given its own connection to the database.
     """
 
     def __init__(self):
-        self.handle = None
+        self.filename = None
+        self.pragmas = ()
+        self.local = local()
 
-    def connect(self, filename):
+    def connect(self, filename, journal_mode=JOURNAL_MODE,
+                synchronous=SYNCHRONOUS):
         """
         Returns a connection to the database
+
+        The journal mode and synchronous level are applied to the connection
+        of every thread.
         """
-        self.handle = connect(filename)
+        self.filename = filename
+        self.pragmas = (('journal_mode', journal_mode),
+                        ('synchronous', synchronous))
+        self.local.handle = self._open()
+
+    def _open(self):
+        """
+        Opens a new connection with the configured pragmas
+        """
+        handle = connect(self.filename)
+
+        for (name, value) in self.pragmas:
+            if value:
+                handle.execute('PRAGMA {0}={1}'.format(name, value))
+
+        return handle
+
+    @property
+    def handle(self):
+        """
+        Returns the connection owned by the current thread
+        """
+        handle = getattr(self.local, 'handle', None)
+
+        if handle is None and self.filename:
+            handle = self.local.handle = self._open()
+
+        return handle
 
     def execute(self, query, params=()):
         """
@@ -63,17 +179,141 @@ def setup(filename, start_index=0):
     """
     database = connect(filename)
     database.execute(CREATE_TABLE_QUERY)
+    upgrade(database)
     database.execute(START_INDEX_QUERY, (start_index,))
+    database.commit()
     database.close()
 
+def upgrade(handle):
+    """
+    Adds the tables missing from databases created by older versions
+    """
+    columns = [row[1] for row in handle.execute('PRAGMA table_info(workflows)')]
+    job_columns = [row[1] for row in handle.execute('PRAGMA table_info(jobs)')]
+
+    with handle:
+        handle.execute(CREATE_JOBS_TABLE_QUERY)
+
+        if job_columns and 'output_ref' not in job_columns:
+            handle.execute('ALTER TABLE jobs ADD COLUMN output_ref TEXT')
+            handle.execute('ALTER TABLE jobs ADD COLUMN output_size INTEGER')
+
+        if columns and 'jobs_hash' not in columns:
+            handle.execute('ALTER TABLE workflows ADD COLUMN jobs_hash TEXT')
+            _backfill_jobs_hash(handle)
+
+        if columns and 'max_tasks' not in columns:
+            handle.execute('ALTER TABLE workflows ADD COLUMN max_tasks INTEGER')
+
+        if columns:
+            handle.execute(CREATE_JOBS_HASH_INDEX_QUERY)
+
+            for query in CREATE_WORKFLOW_INDEX_QUERIES:
+                handle.execute(query)
+
+            _index_submitted(handle)
+
+def _index_submitted(handle):
+    """
+    Indexes the submitted time as a number where SQLite supports it
+    """
+    try:
+        handle.execute(CREATE_SUBMITTED_TIME_INDEX_QUERY)
+    except OperationalError:
+        logger.warn("SQLite %s can not index expressions, the submitted "
+                    "column is indexed instead", sqlite_version)
+        handle.execute(CREATE_SUBMITTED_INDEX_QUERY)
+    else:
+        handle.execute('DROP INDEX IF EXISTS workflows_submitted')
+
+def _backfill_jobs_hash(handle, size=1000):
+    """
+    Computes the jobs hash of the existing workflows
+
+    Workflows whose jobs can not be decoded are left without a hash.
+    """
+    cursor = handle.execute('SELECT id, jobs FROM workflows WHERE jobs IS NOT NULL')
+
+    while True:
+        rows = cursor.fetchmany(size)
+
+        if not rows:
+            break
+
+        params = []
+
+        for (workflow_id, jobs) in rows:
+            try:
+                params.append((jobs_hash(loads(jobs)), workflow_id))
+            except (TypeError, ValueError):
+                logger.warn("DB: the jobs of workflow %s could not be "
+                            "decoded and were not hashed", workflow_id)
+
+        handle.executemany('UPDATE workflows SET jobs_hash=? WHERE id=?', params)
+
 class WorkflowStore(object):
-    def __init__(self, database):
+    """
+    Persists workflows and the state of their jobs.
+
+    Status and job updates are buffered and coalesced per workflow, then
+    written in a single transaction by flush(). Buffered updates are held
+    for at most flush_interval seconds or max_pending updates.
+    """
+
+    def __init__(self, database, flush_interval=FLUSH_INTERVAL,
+                 max_pending=MAX_PENDING):
         self.database = database
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.lock = Lock()
+        self.previous = time()
+        #: workflow id -> (status, completed)
+        self.pending_status = {}
+        #: workflow id -> position -> job row
+        self.pending_jobs = {}
+        self.pending = 0
+        upgrade(self.database.handle)
+
+    @timed(STORE_SECONDS, operation='flush')
+    def flush(self, force=False):
+        """
+        Writes the buffered updates once they are due
+
+        Returns the number of updates written.
+        """
+        with self.lock:
+            due = (self.pending >= self.max_pending or
+                   time() - self.previous >= self.flush_interval)
+
+            if not self.pending or not (force or due):
+                return 0
 
+            rows = [row for jobs in self.pending_jobs.values()
+                    for row in jobs.values()]
+            statuses = [(status, completed, workflow_id)
+                        for (workflow_id, (status, completed))
+                        in self.pending_status.items()]
+
+            with self.database.handle as handle:
+                handle.executemany(SAVE_JOBS_QUERY, rows)
+                handle.executemany(UPDATE_STATUS_QUERY, statuses)
+
+            written = self.pending
+            self.pending_status = {}
+            self.pending_jobs = {}
+            self.pending = 0
+            self.previous = time()
+
+        return written
+
+    @timed(STORE_SECONDS, operation='get_status')
     def get_status(self, workflow_id):
         """
         Returns the status of the workflow
         """
+        with ignored(ValueError, TypeError, KeyError):
+            return self.pending_status[int(workflow_id)][0]
+
         query = '''
             SELECT status FROM workflows
             WHERE id=?
@@ -87,87 +327,152 @@ class WorkflowStore(object):
         else:
             return Status.NotFound
 
+    @timed(STORE_SECONDS, operation='get_statuses')
+    def get_statuses(self, workflow_ids):
+        """
+        Returns the status of each workflow found keyed by its id
+        """
+        ids = sorted(set(int(workflow_id) for workflow_id in workflow_ids))
+        statuses = {}
+
+        #: Stay below the limit of bound parameters of sqlite
+        for start in range(0, len(ids), MAX_PAGE_SIZE):
+            chunk = ids[start:start + MAX_PAGE_SIZE]
+            query = '''
+                SELECT id, status FROM workflows
+                WHERE id IN ({params})
+            '''.format(params=', '.join('?' * len(chunk)))
+
+            cursor = self.database.execute(query, chunk)
+            statuses.update(cursor.fetchall())
+
+        with self.lock:
+            for workflow_id in ids:
+                if workflow_id in self.pending_status:
+                    statuses[workflow_id] = self.pending_status[workflow_id][0]
+
+        return statuses
+
+    @timed(STORE_SECONDS, operation='find_workflow')
     def find_workflow(self, jobs):
         """
         Finds the workflow and returns its id
         """
         query = '''
-            SELECT * FROM workflows
-            WHERE jobs=?
-        '''
-        jobs_json = encoder.encode(jobs)
-        cursor = self.database.execute(query, (jobs_json,))
-        return cursor.fetchone()
+            SELECT {columns} FROM workflows
+            WHERE jobs_hash=?
+        '''.format(columns=WORKFLOW_COLUMNS)
 
+        cursor = self.database.execute(query, (jobs_hash(jobs),))
+
+        #: Guard against hash collisions
+        for row in cursor.fetchall():
+            if row[3] is not None and loads(row[3]) == jobs:
+                return self._overlay(row)
+
+        return None
+
+    @timed(STORE_SECONDS, operation='add_workflow')
     def add_workflow(self, name=None, log=None, jobs=None,
-                    priority=0, status=Status.Initialized):
+                    priority=0, status=Status.Initialized, max_tasks=0):
         """
         Adds the workflow and returns its id
         """
         query = '''
             INSERT INTO workflows(name, log, jobs, submitted, completed,
-                                status, priority)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+                                status, priority, jobs_hash, max_tasks)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
         '''
 
         if jobs:
             job_json = encoder.encode(jobs)
+            job_hash = jobs_hash(jobs)
         else:
             job_json = None
+            job_hash = None
 
-        params = (name, log, job_json, time(), None, status, priority)
+        params = (name, log, job_json, time(), None, status, priority, job_hash,
+                  max_tasks)
 
         cursor = self.database.execute(query, params)
         return cursor.lastrowid
 
+    @timed(STORE_SECONDS, operation='get_workflow')
     def get_workflow(self, workflow_id):
         """
         Returns the pickled workflow from the database
         """
 
         query = """
-            SELECT *
+            SELECT {columns}
             FROM workflows
             WHERE id=?
-        """
+        """.format(columns=WORKFLOW_COLUMNS)
         cursor = self.database.execute(query, (workflow_id,))
-        return cursor.fetchone()
+        return self._overlay(cursor.fetchone())
 
+    def _overlay(self, row):
+        """
+        Returns the workflow row with its buffered status applied
+        """
+        if row is None:
+            return None
+
+        with self.lock:
+            pending = self.pending_status.get(row[0])
+
+        if pending is None:
+            return row
+
+        (status, completed) = pending
+        return row[:5] + (completed,) + row[6:7] + (status,) + row[8:]
+
+    @timed(STORE_SECONDS, operation='update_workflow')
     def update_workflow(self, workflow_id, name=None, log=None, jobs=None,
-                        priority=0):
+                        priority=0, max_tasks=0):
         """
         Persists the pickled workflow into the database
         """
         query = """
             UPDATE workflows
-            SET name=?, log=?, jobs=?, priority=?
+            SET name=?, log=?, jobs=?, priority=?, jobs_hash=?, max_tasks=?
             WHERE id=?
         """
         if jobs:
             job_json = encoder.encode(jobs)
+            job_hash = jobs_hash(jobs)
         else:
             job_json = None
+            job_hash = None
 
-        params = (name, log, job_json, priority, workflow_id)
+        params = (name, log, job_json, priority, job_hash, max_tasks,
+                  workflow_id)
         self.database.execute(query, params)
 
-    def update_status(self, workflow_id, status, completed=False):
+    @timed(STORE_SECONDS, operation='update_options')
+    def update_options(self, workflow_id, priority=0, max_tasks=0):
         """
-        Updates the status of the workflow
+        Updates the priority and concurrent task limit of the workflow
         """
-
         query = '''
             UPDATE workflows
-            SET status=?, completed=? WHERE id=?
+            SET priority=?, max_tasks=? WHERE id=?
         '''
 
-        if completed:
-            params = (status, time(), workflow_id)
-        else:
-            params = (status, None, workflow_id)
+        self.database.execute(query, (priority, max_tasks, workflow_id))
 
-        self.database.execute(query, params)
+    @timed(STORE_SECONDS, operation='update_status')
+    def update_status(self, workflow_id, status, completed=False):
+        """
+        Updates the status of the workflow
+        """
+        completed_time = time() if completed else None
 
+        with self.lock:
+            self.pending_status[workflow_id] = (status, completed_time)
+            self.pending += 1
+
+    @timed(STORE_SECONDS, operation='restart_workflow')
     def restart_workflow(self, workflow_id):
         """
         Update the time the workflow was started
@@ -181,6 +486,7 @@ class WorkflowStore(object):
         params = (time(), workflow_id)
         self.database.execute(query, params)
 
+    @timed(STORE_SECONDS, operation='stop_workflows')
     def stop_workflows(self):
         """
         Set the status of all Running jobs to stopped
@@ -195,33 +501,169 @@ class WorkflowStore(object):
         params = (Status.Stopped, time(), Status.Running)
         self.database.execute(query, params)
 
-    def fetch(self, ids=None, status=None):
+    @timed(STORE_SECONDS, operation='fetch')
+    def fetch(self, ids=None, status=None, name=None, since=None,
+              until=None, cursor=None, limit=PAGE_SIZE):
         """
-        Returns a subset of workflows
+        Returns a page of workflows and the cursor of the next page
 
-        If ids is specified the workflows will be limited to the subset of
-        of workflows with matching ids.
+        Workflows are ordered by id and can be limited to a set of ids, a
+        status, a name prefix and a range of submission times. The cursor is
+        None once there are no more workflows. Buffered status updates are
+        not flushed, statuses trail the scheduler by the flush interval.
         """
+        limit = max(1, min(int(limit or PAGE_SIZE), MAX_PAGE_SIZE))
+        clauses = []
+        params = []
+        more_ids = False
+
+        if cursor is not None:
+            cursor = int(cursor)
+            clauses.append('id > ?')
+            params.append(cursor)
+
+        if ids:
+            selected = sorted(set(int(workflow_id) for workflow_id in ids))
+
+            if cursor is not None:
+                selected = [workflow_id for workflow_id in selected
+                            if workflow_id > cursor]
+
+            if not selected:
+                return ([], None)
+
+            more_ids = len(selected) > limit
+            selected = selected[:limit]
+            clauses.append('id IN ({0})'.format(','.join('?' * len(selected))))
+            params.extend(selected)
+
+        if status:
+            clauses.append('status=?')
+            params.append(status_code(status))
+
+        if name:
+            clauses.append('name >= ? AND name < ?')
+            params.extend((name, name + u'\uffff'))
+
+        if since is not None:
+            clauses.append(SUBMITTED_TIME + ' >= ?')
+            params.append(float(since))
+
+        if until is not None:
+            clauses.append(SUBMITTED_TIME + ' < ?')
+            params.append(float(until))
 
         query = '''
                 SELECT id, name, submitted, completed, status, priority
                 FROM workflows
             '''
 
-        if ids and status:
-            query += ' WHERE id IN ({ids}) AND status={status}'
-            id_string = ",".join(set(str(workflow_id) for workflow_id in ids))
-            status = status_code(status)
-            cursor = self.database.execute(query.format(ids=id_string, status=status))
-        elif ids:
-            query += ' WHERE id IN ({ids})'   
-            id_string = ",".join(set(str(workflow_id) for workflow_id in ids))
-            cursor = self.database.execute(query.format(ids=id_string))
-        elif status:
-            query += ' WHERE status=?'
-            status = status_code(status)
-            cursor = self.database.execute(query, (status,))
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+
+        query += ' ORDER BY id LIMIT ?'
+        params.append(limit + 1)
+
+        rows = self.database.execute(query, params).fetchmany(limit + 1)
+
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1][0]
+        elif more_ids:
+            next_cursor = selected[-1]
         else:
-            cursor = self.database.execute(query)
+            next_cursor = None
 
+        return (rows, next_cursor)
+
+    @timed(STORE_SECONDS, operation='running_workflows')
+    def running_workflows(self):
+        """
+        Returns the workflows that were running
+        """
+        query = '''
+            SELECT {columns}
+            FROM workflows
+            WHERE status=?
+        '''.format(columns=WORKFLOW_COLUMNS)
+
+        cursor = self.database.execute(query, (Status.Running,))
         return cursor.fetchall()
+
+    @timed(STORE_SECONDS, operation='save_jobs')
+    def save_jobs(self, workflow_id, jobs):
+        """
+        Saves the state of the jobs given as (position, job) pairs
+        """
+        with self.lock:
+            rows = self.pending_jobs.setdefault(workflow_id, {})
+
+            for (position, job) in jobs:
+                info = job.info
+                rows[position] = (workflow_id, position, job.status,
+                                  info.get('taskid'), info.get('started'),
+                                  info.get('ended'), info.get('elapsed'),
+                                  info.get('returned'), job.attempts,
+                                  info.get('output_ref'),
+                                  info.get('output_size'))
+
+            self.pending += len(jobs)
+
+    @timed(STORE_SECONDS, operation='get_jobs')
+    def get_jobs(self, workflow_id):
+        """
+        Returns the saved (status, info, attempts) of each job keyed by
+        position
+        """
+        query = '''
+            SELECT position, status, taskid, started, ended, elapsed, returned,
+                   output_ref, output_size, attempts
+            FROM jobs
+            WHERE workflow_id=?
+        '''
+
+        cursor = self.database.execute(query, (workflow_id,))
+        rows = dict((row[0], row[1:]) for row in cursor.fetchall())
+
+        #: Buffered rows are newer than the saved rows
+        with self.lock:
+            for row in self.pending_jobs.get(workflow_id, {}).values():
+                rows[row[1]] = row[2:8] + row[9:] + row[8:9]
+
+        states = {}
+
+        for (position, (status, taskid, started, ended, elapsed,
+                returned, output_ref, output_size, attempts)) in rows.items():
+            info = {}
+
+            if taskid is not None:
+                info = {
+                    'taskid': taskid,
+                    'started': started,
+                    'ended': ended,
+                    'elapsed': elapsed,
+                    'returned': returned
+                }
+
+            if output_ref is not None:
+                info['output_ref'] = output_ref
+                info['output_size'] = output_size
+
+            states[position] = (status, info, attempts or 1)
+
+        return states
+
+    @timed(STORE_SECONDS, operation='clear_jobs')
+    def clear_jobs(self, workflow_id):
+        """
+        Removes the saved state of the jobs of the workflow
+        """
+        query = '''
+            DELETE FROM jobs
+            WHERE workflow_id=?
+        '''
+
+        with self.lock:
+            self.pending_jobs.pop(workflow_id, None)
+
+        self.database.execute(query, (workflow_id,))
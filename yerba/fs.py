@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+from logging import getLogger
+from multiprocessing.pool import ThreadPool
+from os import stat
+from stat import S_ISDIR, S_ISREG
+from time import time
+
+logger = getLogger('yerba.fs')
+
+STAT_TTL = 5
+STAT_THREADS = 8
+MAX_ENTRIES = 500000
+
+def _probe(path):
+    '''Returns the stat of the path or None if it does not exist'''
+    try:
+        return stat(path)
+    except OSError:
+        return None
+
+class StatCache(object):
+    """
+    A cache of file stats keyed by absolute path.
+
+    Entries expire after ttl seconds or when they are invalidated.
+    Missing paths are cached as well so repeated lookups are cheap.
+    """
+
+    def __init__(self, ttl=STAT_TTL, threads=STAT_THREADS):
+        self.ttl = ttl
+        self.threads = threads
+        self.entries = {}
+        self.pool = None
+
+    def configure(self, ttl=None, threads=None):
+        '''Updates the ttl and the number of threads used for probing'''
+        if ttl is not None:
+            self.ttl = ttl
+
+        if threads is not None and threads != self.threads:
+            self.threads = threads
+
+            if self.pool:
+                self.pool.close()
+                self.pool = None
+
+    def stat(self, path):
+        '''Returns the stat of the path or None if it does not exist'''
+        now = time()
+        entry = self.entries.get(path)
+
+        if entry and entry[0] > now:
+            return entry[1]
+
+        result = _probe(path)
+        self.entries[path] = (now + self.ttl, result)
+        return result
+
+    def prefetch(self, paths):
+        '''
+        Probes every path that is not cached.
+
+        The cold paths are probed in parallel so that the wait is bounded by
+        the slowest path rather than the sum of all of them.
+        '''
+        now = time()
+        cold = [path for path in set(paths)
+                if path not in self.entries or self.entries[path][0] <= now]
+
+        if not cold:
+            return
+
+        if len(cold) == 1 or self.threads < 2:
+            results = [_probe(path) for path in cold]
+        else:
+            if not self.pool:
+                self.pool = ThreadPool(self.threads)
+
+            results = self.pool.map(_probe, cold)
+
+        if len(self.entries) > MAX_ENTRIES:
+            self.purge()
+
+        expires = time() + self.ttl
+
+        for (path, result) in zip(cold, results):
+            self.entries[path] = (expires, result)
+
+    def invalidate(self, *paths):
+        '''Removes the paths from the cache'''
+        for path in paths:
+            self.entries.pop(path, None)
+
+    def purge(self):
+        '''Removes all expired entries'''
+        now = time()
+        self.entries = dict((path, entry)
+                            for (path, entry) in self.entries.iteritems()
+                            if entry[0] > now)
+
+    def clear(self):
+        '''Removes all entries'''
+        self.entries.clear()
+
+    def isfile(self, path):
+        '''Returns whether the path is a regular file'''
+        result = self.stat(path)
+        return result is not None and S_ISREG(result.st_mode)
+
+    def isdir(self, path):
+        '''Returns whether the path is a directory'''
+        result = self.stat(path)
+        return result is not None and S_ISDIR(result.st_mode)
+
+    def is_empty(self, path):
+        """
+        Return whether or not the file is empty
+
+        If the path is not a valid file an OSError
+        will be raised.
+        """
+        if not self.isfile(path):
+            raise OSError(2, "No such file", path)
+
+        return self.stat(path).st_size == 0
+
+#: Cache shared by every workflow in the daemon
+stat_cache = StatCache()
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+
+from collections import OrderedDict
+from datetime import datetime
+from logging import getLogger
+from multiprocessing import cpu_count
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+from time import time
+
+from yerba.services import Executor, DATE_FORMAT, DISPATCH_SIZE
+from yerba.utils import ignored
+
+logger = getLogger('yerba.local')
+
+MAX_OUTPUT = 65536
+OUTPUT_FILE = '.yerba-output'
+
+def _entry(item):
+    '''Returns the absolute path of an input or output and its sandbox name'''
+    if isinstance(item, list):
+        item = item[0]
+
+    path = os.path.abspath(str(item))
+    return (path, os.path.basename(path))
+
+def _replace(source, target):
+    '''Moves the source over the target'''
+    if os.path.isdir(target) and not os.path.islink(target):
+        shutil.rmtree(target)
+    elif os.path.lexists(target):
+        os.remove(target)
+
+    shutil.move(source, target)
+
+class LocalTask(object):
+    """
+    A job command run in a sandbox directory on the daemon host.
+
+    Like a work_queue worker the inputs are linked into the sandbox under
+    their base name and outputs written there are moved to their paths
+    once the command exits.
+    """
+
+    def __init__(self, taskid, job, directory):
+        self.id = taskid
+        self.job = job
+        self.command = str(job)
+        self.sandbox = tempfile.mkdtemp(prefix='task-%s-' % taskid,
+                                        dir=directory)
+
+        for item in job.inputs:
+            (path, name) = _entry(item)
+
+            with ignored(OSError):
+                os.symlink(path, os.path.join(self.sandbox, name))
+
+        self.output = open(os.path.join(self.sandbox, OUTPUT_FILE), 'w+')
+        self.started = time()
+
+        try:
+            self.process = subprocess.Popen(self.command, shell=True,
+                                            cwd=self.sandbox,
+                                            stdout=self.output,
+                                            stderr=subprocess.STDOUT,
+                                            close_fds=True,
+                                            preexec_fn=os.setsid)
+        except Exception:
+            self.remove()
+            raise
+
+    def done(self):
+        '''Returns whether the command exited'''
+        return self.process.poll() is not None
+
+    def collect(self):
+        '''Moves the outputs to their paths and returns the task info'''
+        ended = time()
+        self.output.seek(0)
+        output = self.output.read(MAX_OUTPUT)
+
+        for item in self.job.outputs:
+            (path, name) = _entry(item)
+            source = os.path.join(self.sandbox, name)
+
+            if os.path.lexists(source) and not os.path.islink(source):
+                try:
+                    _replace(source, path)
+                except (IOError, OSError):
+                    logger.exception("LOCAL: the output %s could not be moved",
+                                     path)
+
+        self.remove()
+
+        return {
+            'cmd' : self.command,
+            'started' : datetime.fromtimestamp(self.started).strftime(
+                DATE_FORMAT),
+            'ended' : datetime.fromtimestamp(ended).strftime(DATE_FORMAT),
+            'elapsed' : ended - self.started,
+            'taskid' : self.id,
+            'returned' : self.process.returncode,
+            'output' : repr(output),
+        }
+
+    def kill(self):
+        '''Kills the command and its children'''
+        if not self.done():
+            with ignored(OSError):
+                os.killpg(self.process.pid, signal.SIGKILL)
+
+            self.process.wait()
+
+        self.remove()
+
+    def remove(self):
+        '''Removes the sandbox of the task'''
+        with ignored(IOError, OSError):
+            self.output.close()
+
+        shutil.rmtree(self.sandbox, ignore_errors=True)
+
+class LocalExecutorService(Executor):
+    """
+    Runs jobs as processes on the daemon host.
+
+    At most processes commands run at once, the remaining jobs wait in the
+    fair share dispatcher like they do for work_queue.
+    """
+    name = "local"
+
+    def __init__(self, config, notifier):
+        Executor.__init__(self, notifier,
+            max_tasks=int(config.get('workflow-max-tasks', 0)),
+            dispatch_size=int(config.get('dispatch-size', DISPATCH_SIZE)))
+        self.processes = int(config.get('processes') or cpu_count())
+        self.root = config.get('directory') or None
+        self.directory = None
+        self.commands = [command.strip() for command
+                         in (config.get('commands') or '').split(',')
+                         if command.strip()]
+        self.ids = 0
+        #: taskid -> running task
+        self.running = OrderedDict()
+
+    def initialize(self):
+        '''Creates the directory holding the sandboxes of the tasks'''
+        if self.root:
+            with ignored(OSError):
+                os.makedirs(self.root)
+
+        self.directory = tempfile.mkdtemp(prefix='yerba-local-', dir=self.root)
+        logger.info('LOCAL: Running up to %s tasks in %s', self.processes,
+                    self.directory)
+
+    def stop(self):
+        '''Kills the running tasks and removes their sandboxes'''
+        logger.info('LOCAL: Stopping %s running tasks', len(self.running))
+
+        for task in self.running.values():
+            task.kill()
+
+        self.running.clear()
+
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def hungry(self):
+        '''Returns whether a process is free'''
+        return len(self.running) < self.processes
+
+    def capacity(self):
+        '''Returns the number of processes'''
+        return self.processes
+
+    def _run(self, new_job, name, priority):
+        '''Starts the command of the job'''
+        self.ids += 1
+        self.running[self.ids] = LocalTask(self.ids, new_job, self.directory)
+        return self.ids
+
+    def update(self):
+        '''
+        Collects the tasks that exited and starts pending jobs.
+
+        Each workflow is notified once with all of its finished jobs.
+        Returns whether a task finished or was started.
+        '''
+        finished = OrderedDict()
+        received = 0
+
+        for (taskid, task) in list(self.running.items()):
+            if not task.done():
+                continue
+
+            del self.running[taskid]
+            received += 1
+            info = task.collect()
+            logger.debug('LOCAL: Task %s exited with status %s', taskid,
+                         info['returned'])
+            self._finish(taskid, info, finished)
+
+        dispatched = self._dispatch()
+        rejected = self._reject(finished)
+
+        if not received and not rejected:
+            return dispatched > 0
+
+        self._notify(finished)
+        return True
+
+    def _cancel_task(self, taskid):
+        '''Kills the task'''
+        task = self.running.pop(taskid, None)
+
+        if task is None:
+            return False
+
+        task.kill()
+        return True
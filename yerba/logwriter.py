@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from logging import getLogger
+from threading import Event, Lock, Thread
+
+from yerba.utils import ignored
+
+logger = getLogger('yerba.logwriter')
+
+FLUSH_INTERVAL = 1.0
+MAX_BUFFER = 64 * 1024
+MAX_HANDLES = 64
+
+class LogWriter(object):
+    """
+    Appends text to log files from a background thread.
+
+    Writes are buffered per file and flushed every interval seconds or
+    once a file has more than max_buffer bytes waiting. At most
+    max_handles files are kept open, the least recently used are closed
+    first.
+    """
+
+    def __init__(self, interval=FLUSH_INTERVAL, max_buffer=MAX_BUFFER,
+                 max_handles=MAX_HANDLES):
+        self.interval = interval
+        self.max_buffer = max_buffer
+        self.max_handles = max_handles
+        self.lock = Lock()
+        self.wakeup = Event()
+        #: path -> pieces of text waiting to be written
+        self.buffers = OrderedDict()
+        #: path -> bytes waiting to be written
+        self.sizes = {}
+        #: path -> open file in least recently used order
+        self.handles = OrderedDict()
+        self.thread = None
+        self.running = False
+
+    def configure(self, interval=None, max_buffer=None, max_handles=None):
+        '''Updates the flush interval and limits'''
+        if interval is not None:
+            self.interval = interval
+
+        if max_buffer is not None:
+            self.max_buffer = max_buffer
+
+        if max_handles is not None:
+            self.max_handles = max_handles
+
+    def write(self, path, text):
+        '''Queues the text to be appended to the file at path'''
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+
+        with self.lock:
+            self.buffers.setdefault(path, []).append(text)
+            size = self.sizes.get(path, 0) + len(text)
+            self.sizes[path] = size
+
+            if not self.running:
+                self._start()
+
+        if size >= self.max_buffer:
+            self.wakeup.set()
+
+    def close(self):
+        '''Writes the buffered text and closes every file'''
+        with self.lock:
+            thread = self.thread
+            self.running = False
+            self.thread = None
+
+        if thread:
+            self.wakeup.set()
+            thread.join()
+
+        self._flush()
+
+        for handle in self.handles.values():
+            with ignored(IOError, OSError):
+                handle.close()
+
+        self.handles.clear()
+
+    def _start(self):
+        '''Starts the writer thread'''
+        self.running = True
+        self.thread = Thread(target=self._run, name="yerba-logwriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        '''Flushes the buffers until the writer is closed'''
+        while self.running:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+            try:
+                self._flush()
+            except Exception:
+                logger.exception("LOGWRITER: failed to flush the logs")
+
+    def _flush(self):
+        '''Writes the buffered text of every file'''
+        with self.lock:
+            (buffers, self.buffers) = (self.buffers, OrderedDict())
+            self.sizes = {}
+
+        for (path, pieces) in buffers.items():
+            try:
+                handle = self._open(path)
+                handle.write(''.join(pieces))
+                handle.flush()
+            except (IOError, OSError):
+                logger.warn("LOGWRITER: the log %s could not be written",
+                            path)
+                self._close(path)
+
+    def _open(self, path):
+        '''Returns the open file for the path'''
+        handle = self.handles.pop(path, None)
+
+        if handle is None:
+            while len(self.handles) >= self.max_handles:
+                (_, oldest) = self.handles.popitem(last=False)
+
+                with ignored(IOError, OSError):
+                    oldest.close()
+
+            handle = open(path, 'a')
+
+        self.handles[path] = handle
+        return handle
+
+    def _close(self, path):
+        '''Closes the file for the path if it is open'''
+        handle = self.handles.pop(path, None)
+
+        if handle is not None:
+            with ignored(IOError, OSError):
+                handle.close()
+
+#: Writer shared by every workflow in the daemon
+log_writer = LogWriter()
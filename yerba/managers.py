@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
+from heapq import heappop, heappush
 from logging import getLogger
 from os import getloadavg
 from time import time, sleep
 import json
 
-from yerba.core import Status, status_name, SCHEDULE_TASK, CANCEL_TASK
-from yerba.db import Database, WorkflowStore
-from yerba.workflow import WorkflowError, Workflow
+from yerba.cache import WorkflowCache
+from yerba.core import (Status, status_name, DONE_STATUS, SCHEDULE_TASK,
+                        CANCEL_TASK, WATCH_INPUTS, WORKFLOW_CHANGED)
+from yerba.metrics import UPDATE_SECONDS, SERVICE_UPDATE_SECONDS
+from yerba.spill import output_store
+from yerba.db import (Database, WorkflowStore, JOURNAL_MODE, SYNCHRONOUS,
+                      FLUSH_INTERVAL, MAX_PENDING)
+from yerba.workflow import (WorkflowError, Workflow, RETRY_DELAY,
+                            MAX_RETRY_DELAY)
 from yerba.utils import ignored, meminfo
 
 logger = getLogger('yerba.manager')
@@ -66,10 +73,31 @@ class ServiceManager(object):
         cls.RUNNING = True
 
     @classmethod
-    def update(cls):
-        '''Run service update callback.'''
-        for service in cls.core.values():
-            service.update()
+    def update(cls, budget=0):
+        '''
+        Run service update callback.
+
+        Services are updated repeatedly while any of them report that work
+        was done and the time budget (in seconds) has not been spent.
+        Returns whether any service did work.
+        '''
+        start = time()
+        deadline = start + budget
+        busy = False
+
+        while True:
+            active = False
+
+            for service in cls.core.values():
+                with SERVICE_UPDATE_SECONDS.time(service=service.name):
+                    if service.update():
+                        active = True
+
+            busy = busy or active
+
+            if not active or time() >= deadline:
+                UPDATE_SECONDS.observe(time() - start)
+                return busy
 
     @classmethod
     def stop(cls):
@@ -162,8 +190,15 @@ def report_state():
 class WorkflowManager(object):
     database = Database()
     store = None
-    workflows = {}
+    workflows = WorkflowCache()
     notifier = None
+    input_timeout = 0
+    retry_delay = RETRY_DELAY
+    max_retry_delay = MAX_RETRY_DELAY
+    #: (time, workflow id) of the workflows with failed jobs to run again
+    retries = []
+    #: workflow id -> time of its next retry in retries
+    retry_times = {}
 
     @classmethod
     def set_notifier(cls, notifier):
@@ -171,10 +206,61 @@ class WorkflowManager(object):
         cls.notifier = notifier
 
     @classmethod
-    def connect(cls, filename):
+    def connect(cls, filename, journal_mode=JOURNAL_MODE,
+                synchronous=SYNCHRONOUS, flush_interval=FLUSH_INTERVAL,
+                max_pending=MAX_PENDING):
         '''Connect to workflow database'''
-        cls.database.connect(filename)
-        cls.store = WorkflowStore(cls.database)
+        cls.database.connect(filename, journal_mode=journal_mode,
+                             synchronous=synchronous)
+        cls.store = WorkflowStore(cls.database, flush_interval=flush_interval,
+                                  max_pending=max_pending)
+
+    @classmethod
+    def flush(cls, force=False):
+        '''Writes the buffered workflow updates to the database'''
+        if cls.store:
+            cls.store.flush(force=force)
+
+    @classmethod
+    def evict(cls):
+        '''Evicts finished workflows from memory'''
+        return cls.workflows.evict()
+
+    @classmethod
+    def retry(cls):
+        '''Schedules the workflows whose failed jobs may run again'''
+        now = time()
+
+        while cls.retries and cls.retries[0][0] <= now:
+            (due, workflow_id) = heappop(cls.retries)
+
+            #: Skip retries superseded by an earlier one
+            if cls.retry_times.get(workflow_id) != due:
+                continue
+
+            del cls.retry_times[workflow_id]
+
+            with ignored(KeyError):
+                workflow = cls.workflows[workflow_id]
+
+                if workflow.status not in DONE_STATUS:
+                    cls.schedule(workflow_id, workflow)
+
+    @classmethod
+    def _defer(cls, workflow_id, workflow):
+        '''Queues the next retry of the failed jobs of the workflow'''
+        due = workflow.retry_at
+
+        if due is not None and cls.retry_times.get(workflow_id) != due:
+            cls.retry_times[workflow_id] = due
+            heappush(cls.retries, (due, workflow_id))
+
+    @classmethod
+    def _configure(cls, workflow):
+        '''Applies the input timeout and retry backoff to the workflow'''
+        workflow.input_timeout = cls.input_timeout
+        workflow.retry_delay = cls.retry_delay
+        workflow.max_retry_delay = cls.max_retry_delay
 
     @classmethod
     def create(cls, workflow=None, jobs_object=None, status=Status.Initialized):
@@ -183,7 +269,8 @@ class WorkflowManager(object):
         if workflow and jobs_object:
             workflow_id = cls.store.add_workflow(
                 name=workflow.name, log=workflow.log, jobs=jobs_object,
-                status=status, priority=workflow.priority)
+                status=status, priority=workflow.priority,
+                max_tasks=workflow.max_tasks)
         else:
             workflow_id = cls.store.add_workflow(status=status)
 
@@ -197,6 +284,7 @@ class WorkflowManager(object):
 
         try:
             workflow = Workflow.from_object(data)
+            cls._configure(workflow)
         except WorkflowError as e:
             logger.exception("the workflow failed to be generated")
             return (None, Status.Error, e.errors)
@@ -214,7 +302,7 @@ class WorkflowManager(object):
             workflow_found = cls.store.find_workflow(data['jobs'])
 
         if workflow_found:
-            (workflow_id, _, _, _, _, _, _, status) = workflow_found
+            (workflow_id, _, _, _, _, _, _, status, _) = workflow_found
 
             if workflow_id in cls.workflows and status == Status.Running:
                 logger.info("workflow id=%s is already runnning", workflow_id)
@@ -224,13 +312,18 @@ class WorkflowManager(object):
                 logger.info("updating workflow id=%s", workflow_id)
                 cls.store.update_workflow(workflow_id,
                     name=workflow.name, log=workflow.log, jobs=data['jobs'],
-                    priority=workflow.priority)
+                    priority=workflow.priority, max_tasks=workflow.max_tasks)
+            else:
+                cls.store.update_options(workflow_id,
+                    priority=workflow.priority, max_tasks=workflow.max_tasks)
         else:
 
             (workflow_id, _) = cls.create(workflow=workflow,
                                           jobs_object=data['jobs'])
 
         cls.workflows[workflow_id] = workflow
+        cls.store.clear_jobs(workflow_id)
+        output_store.remove(workflow_id)
         scheduled_status = cls.schedule(workflow_id, workflow)
 
         return (workflow_id, scheduled_status, None)
@@ -240,57 +333,203 @@ class WorkflowManager(object):
         '''Schedules a workflow by its id'''
 
         jobs = workflow.next()
-        cls.store.update_status(workflow_id, workflow.status)
+        cls.store.update_status(workflow_id, workflow.status,
+                                completed=workflow.status in DONE_STATUS)
 
         #: Submit any jobs to the queue
         if jobs:
             cls.notifier.notify(SCHEDULE_TASK, jobs, workflow_id,
-                                priority=workflow.priority)
+                                priority=workflow.priority,
+                                limit=workflow.max_tasks)
             logger.info("submitted workflow id=%s", workflow_id)
 
+        cls._watch(workflow_id, workflow)
+        cls._defer(workflow_id, workflow)
+        cls._save_jobs(workflow_id, workflow)
+
+        if workflow.status in DONE_STATUS:
+            cls.workflows.finish(workflow_id)
+
         return workflow.status
 
     @classmethod
-    def get_workflows(cls, ids, status):
-        '''Returns all matching workflows in the job engine'''
-        return cls.store.fetch(ids, status)
+    def get_workflows(cls, **filters):
+        '''Returns a page of matching workflows and the next cursor'''
+        return cls.store.fetch(**filters)
+
+    @classmethod
+    def update(cls, workflow_id, results):
+        '''Updates the workflow with a batch of finished jobs'''
+        try:
+            workflow = cls.workflows[workflow_id]
+        except KeyError:
+            logger.warn("workflow id=%s was not found, dropping %s finished "
+                        "jobs", workflow_id, len(results))
+            return
+
+        #: Update the status of the workflow
+        for (finished, info) in results:
+            job = workflow.find(finished)
+
+            if job is None:
+                logger.warn("workflow id=%s has no running job %s, dropping "
+                            "its result", workflow_id, finished)
+                continue
+
+            workflow.update_status(job, info)
+
+            #: The output was logged, the job only keeps a reference
+            output_store.spill(workflow_id, info)
+
+        #: Fetch next set of tasks and update the worflow
+        iterable = workflow.next()
+
+        logger.info("updating workflow id=%s status=%s",
+                    workflow.name, status_name(workflow.status))
+
+        #: Save the status to the store and submit tasks
+        if workflow.status != Status.Running:
+            cls.store.update_status(workflow_id, workflow.status,
+                             completed=True)
+        else:
+            cls.notifier.notify(SCHEDULE_TASK, iterable, workflow_id,
+                                priority=workflow.priority,
+                                limit=workflow.max_tasks)
+            cls.store.update_status(workflow_id, workflow.status)
+
+        cls._watch(workflow_id, workflow)
+        cls._defer(workflow_id, workflow)
+        cls._save_jobs(workflow_id, workflow)
+
+        if workflow.status in DONE_STATUS:
+            cls.workflows.finish(workflow_id)
 
     @classmethod
-    def update(cls, workflow_id, job, info):
-        '''Updates the job with details'''
+    def wake(cls, workflow_id):
+        '''Rechecks the jobs of the workflow waiting on inputs'''
 
         with ignored(KeyError):
             workflow = cls.workflows[workflow_id]
 
-            #: Update the status of the workflow
-            workflow.update_status(job, info)
+            if workflow.status in DONE_STATUS:
+                return
 
-            #: Fetch next set of tasks and update the worflow
-            iterable = workflow.next()
+            logger.info("waking workflow id=%s", workflow_id)
+            workflow.recheck()
+            cls.schedule(workflow_id, workflow)
 
-            logger.info("updating workflow id=%s status=%s",
-                        workflow.name, status_name(workflow.status))
+    @classmethod
+    def requeue(cls, workflow_id, jobs):
+        '''Returns jobs that were not submitted to wait on their inputs'''
 
-            #: Save the status to the store and submit tasks
-            if workflow.status != Status.Running:
-                cls.store.update_status(workflow_id, workflow.status,
-                                 completed=True)
-            else:
-                cls.notifier.notify(SCHEDULE_TASK, iterable, workflow_id,
-                                    priority=workflow.priority)
-                cls.store.update_status(workflow_id, workflow.status)
+        with ignored(KeyError):
+            workflow = cls.workflows[workflow_id]
+            workflow.requeue(jobs)
+            cls._watch(workflow_id, workflow)
+            cls._save_jobs(workflow_id, workflow)
+
+    @classmethod
+    def _watch(cls, workflow_id, workflow):
+        '''Watches the inputs the workflow is waiting on'''
+        if workflow.waiting and workflow.status not in DONE_STATUS:
+            cls.notifier.notify(WATCH_INPUTS, workflow_id,
+                                workflow.missing_inputs(), workflow.deadline)
+        else:
+            cls.notifier.notify(WATCH_INPUTS, workflow_id, [])
+
+    @classmethod
+    def _save_jobs(cls, workflow_id, workflow):
+        '''Saves and announces the jobs of the workflow that changed'''
+        changes = workflow.pop_changes()
+
+        if changes:
+            cls.store.save_jobs(workflow_id, changes)
+
+        cls.notifier.notify(WORKFLOW_CHANGED, workflow_id, workflow, changes)
+
+    @classmethod
+    def status(cls, workflow_id, since=None, output=False):
+        """
+        Gets the status of the current workflow.
+
+        Returns the status, the state of the jobs and the cursor to pass as
+        since in the next call. Given since, only the jobs that changed
+        after it are returned along with their position. The output of the
+        jobs is only read from the spill files when output is True.
+        """
+        return cls.statuses([(workflow_id, since, output)])[0]
+
+    @classmethod
+    def statuses(cls, queries):
+        """
+        Gets the status of the workflows given as (id, since, output).
+
+        The statuses are read from the store with a single query and the
+        results are returned in the order of the queries.
+        """
+        ids = []
+
+        for (workflow_id, _, _) in queries:
+            with ignored(ValueError, TypeError):
+                ids.append(int(workflow_id))
+
+        found = cls.store.get_statuses(ids)
+        return [cls._state(workflow_id, found, since, output)
+                for (workflow_id, since, output) in queries]
 
     @classmethod
-    def status(cls, workflow_id):
-        '''Gets the status of the current workflow.'''
-        status = cls.store.get_status(workflow_id)
+    def _state(cls, workflow_id, statuses, since=None, output=False):
+        '''Returns the status, jobs and cursor of the workflow'''
+        status = Status.NotFound
         jobs = []
+        cursor = None
 
-        with ignored(KeyError):
-            workflow = cls.workflows[int(workflow_id)]
-            jobs = workflow.state()
+        with ignored(KeyError, ValueError, TypeError):
+            workflow_id = int(workflow_id)
+            status = statuses[workflow_id]
+            workflow = cls.workflows.get(workflow_id)
+
+            if workflow is None and status in DONE_STATUS:
+                workflow = cls._rehydrate(workflow_id, status)
+
+            if workflow:
+                cursor = workflow.cursor
+
+                if since is None:
+                    jobs = workflow.state()
+                else:
+                    jobs = [dict(job.state, position=position)
+                            for (position, job)
+                            in workflow.changed(int(since))]
+
+        if output:
+            for state in jobs:
+                if state.get('output_ref'):
+                    state['output'] = output_store.read(state['output_ref'])
+
+        return (status, jobs, cursor)
+
+    @classmethod
+    def _rehydrate(cls, workflow_id, status):
+        """
+        Returns a finished workflow that is no longer held in memory.
+
+        The workflow is rebuilt from the store with the saved state of its
+        jobs and cached until it is evicted again.
+        """
+        workflow_found = cls.store.get_workflow(workflow_id)
+
+        if not workflow_found:
+            return None
+
+        (wid, workflow) = cls._load(workflow_found, overwrite=False)
+
+        if not workflow:
+            return None
 
-        return (status, jobs)
+        workflow.rehydrate(cls.store.get_jobs(wid), status)
+        logger.debug("rehydrated workflow id=%s", wid)
+        return cls.workflows.add_finished(wid, workflow)
 
     @classmethod
     def cancel(cls, workflow_id):
@@ -306,7 +545,9 @@ class WorkflowManager(object):
             status = workflow.status
 
             cls.store.update_status(int(workflow_id), status, completed=True)
+            cls._save_jobs(int(workflow_id), workflow)
             cls.notifier.notify(CANCEL_TASK, int(workflow_id))
+            cls.workflows.finish(int(workflow_id))
 
         return status
 
@@ -317,29 +558,66 @@ class WorkflowManager(object):
         if not workflow_found:
             return Status.NotFound
 
-        (wid, name, log, jobs, _, _, priority, _) = workflow_found
+        (wid, workflow) = cls._load(workflow_found)
+
+        if not workflow:
+            return Status.Error
+
+        logger.debug("restarting workflow name=%s", workflow.name)
+        cls.workflows[wid] = workflow
+        cls.store.restart_workflow(workflow_id)
+        cls.store.clear_jobs(wid)
+        output_store.remove(wid)
+        return cls.schedule(wid, workflow)
+
+    @classmethod
+    def recover(cls):
+        """
+        Reloads the workflows that were running when the daemon stopped.
+
+        Jobs that finished are restored from the store and only the
+        unfinished jobs are scheduled again.
+        """
+        for workflow_found in cls.store.running_workflows():
+            #: Outputs of finished jobs are kept, they are not run again
+            (wid, workflow) = cls._load(workflow_found, overwrite=False)
+
+            if not workflow:
+                cls.store.update_status(wid, Status.Stopped, completed=True)
+                continue
+
+            workflow.restore(cls.store.get_jobs(wid))
+            logger.info("recovering workflow id=%s", wid)
+            cls.workflows[wid] = workflow
+            cls.schedule(wid, workflow)
+
+    @classmethod
+    def _load(cls, workflow_found, overwrite=True):
+        """
+        Returns the id and workflow generated from a row of the store
+        """
+        (wid, name, log, jobs, _, _, priority, _, max_tasks) = workflow_found
 
         data = {
             "name": name,
             "priority": priority,
+            "max_tasks": max_tasks,
             "logfile": log,
             "jobs": json.loads(jobs)
         }
 
         try:
-            workflow = Workflow.from_object(data)
-            logger.debug("restarting workflow name=%s", workflow.name)
+            workflow = Workflow.from_object(data, overwrite=overwrite)
+            cls._configure(workflow)
         except WorkflowError as e:
             logger.exception("the workflow failed to be generated")
-            return Status.Error
+            return (wid, None)
         except Exception as e:
             logger.exception("""an unexpected error occured during
                             workflow generation""")
-            return Status.Error
+            return (wid, None)
 
-        cls.workflows[wid] = workflow
-        cls.store.restart_workflow(workflow_id)
-        return cls.schedule(wid, workflow)
+        return (wid, workflow)
 
     @classmethod
     def cleanup(cls):
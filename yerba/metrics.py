@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from logging import getLogger
+from threading import Lock, Thread
+from time import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+logger = getLogger('yerba.metrics')
+
+#: Upper bounds in seconds of the histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+def _key(labels):
+    '''Returns the labels as a hashable key'''
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra=()):
+    '''Returns the labels in the text exposition format'''
+    pairs = list(key) + list(extra)
+
+    if not pairs:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('"', '\\"'))
+                             for (name, value) in pairs)
+
+class Counter(object):
+    """A count that only increases, kept per set of labels"""
+    kind = 'counter'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.lock = Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        '''Increases the count of the labels'''
+        key = _key(labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self):
+        '''Returns the count of each set of labels'''
+        with self.lock:
+            return [(dict(key), value) for (key, value) in self.values.items()]
+
+    def exposition(self):
+        '''Returns the lines of the text exposition format'''
+        with self.lock:
+            return ['%s%s %s' % (self.name, _format_labels(key), value)
+                    for (key, value) in sorted(self.values.items())]
+
+class Histogram(object):
+    """A distribution of observed values, kept per set of labels"""
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.lock = Lock()
+        #: labels -> [bucket counts, count, sum]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        '''Records a value for the labels'''
+        key = _key(labels)
+        index = bisect_left(self.buckets, value)
+
+        with self.lock:
+            entry = self.values.get(key)
+
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+
+            if index < len(self.buckets):
+                entry[0][index] += 1
+
+            entry[1] += 1
+            entry[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        '''Observes the time spent in the block'''
+        start = time()
+
+        try:
+            yield
+        finally:
+            self.observe(time() - start, **labels)
+
+    def snapshot(self):
+        '''Returns the count, sum and cumulative buckets of each labels'''
+        with self.lock:
+            entries = [(dict(key), list(counts), count, total)
+                       for (key, (counts, count, total))
+                       in self.values.items()]
+
+        result = []
+
+        for (labels, counts, count, total) in entries:
+            cumulative = 0
+            buckets = []
+
+            for (bound, bucket) in zip(self.buckets, counts):
+                cumulative += bucket
+                buckets.append([bound, cumulative])
+
+            result.append((labels, {"count" : count, "sum" : total,
+                                    "buckets" : buckets}))
+
+        return result
+
+    def exposition(self):
+        '''Returns the lines of the text exposition format'''
+        lines = []
+
+        for (labels, value) in sorted(self.snapshot(),
+                                      key=lambda item: _key(item[0])):
+            key = _key(labels)
+
+            for (bound, cumulative) in value["buckets"]:
+                lines.append('%s_bucket%s %s' % (
+                    self.name, _format_labels(key, [('le', bound)]),
+                    cumulative))
+
+            lines.append('%s_bucket%s %s' % (
+                self.name, _format_labels(key, [('le', '+Inf')]),
+                value["count"]))
+            lines.append('%s_sum%s %s' % (self.name, _format_labels(key),
+                                          value["sum"]))
+            lines.append('%s_count%s %s' % (self.name, _format_labels(key),
+                                            value["count"]))
+
+        return lines
+
+class Registry(object):
+    """
+    Holds the metrics of the job engine.
+
+    Collectors are callbacks returning (name, labels, value) gauges that
+    are read when the metrics are reported.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, description):
+        '''Returns a new counter'''
+        metric = Counter(name, description)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, description, buckets=BUCKETS):
+        '''Returns a new histogram'''
+        metric = Histogram(name, description, buckets=buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        '''Adds a callback returning gauges'''
+        self.collectors.append(collector)
+
+    def unregister_collector(self, collector):
+        '''Removes a callback returning gauges'''
+        self.collectors.remove(collector)
+
+    def gauges(self):
+        '''Returns the gauges of every collector'''
+        gauges = []
+
+        for collector in list(self.collectors):
+            try:
+                gauges.extend(collector())
+            except Exception:
+                logger.exception("METRICS: a collector failed")
+
+        return gauges
+
+    def snapshot(self):
+        '''Returns every metric as a json friendly object'''
+        result = {}
+
+        for metric in self.metrics:
+            result[metric.name] = [{"labels" : labels, "value" : value}
+                                   for (labels, value) in metric.snapshot()]
+
+        for (name, labels, value) in self.gauges():
+            result.setdefault(name, []).append({"labels" : labels,
+                                                "value" : value})
+
+        return result
+
+    def exposition(self):
+        '''Returns every metric in the plain text exposition format'''
+        lines = []
+
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.description))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.exposition())
+
+        typed = set()
+
+        for (name, labels, value) in self.gauges():
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s gauge' % name)
+
+            lines.append('%s%s %s' % (name, _format_labels(_key(labels)),
+                                      value))
+
+        return '\n'.join(lines) + '\n'
+
+def timed(histogram, **labels):
+    '''Decorates a function to observe the time spent in each call'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kw):
+            with histogram.time(**labels):
+                return func(*args, **kw)
+        return wrapper
+    return decorator
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    '''Serves the metrics in the plain text exposition format'''
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = registry.exposition()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("METRICS: " + format, *args)
+
+def serve(port, host=''):
+    '''Serves the metrics over http from a background thread'''
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = Thread(target=server.serve_forever, name="yerba-metrics")
+    thread.daemon = True
+    thread.start()
+    logger.info("METRICS: serving metrics on port %s", port)
+    return server
+
+#: Metrics of the job engine
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+    'yerba_request_seconds', 'Time spent serving requests by route')
+REQUEST_ERRORS = registry.counter(
+    'yerba_request_errors_total', 'Requests that raised an error by route')
+UPDATE_SECONDS = registry.histogram(
+    'yerba_update_seconds', 'Time spent in each update of the services')
+SERVICE_UPDATE_SECONDS = registry.histogram(
+    'yerba_service_update_seconds', 'Time spent in each service update')
+STORE_SECONDS = registry.histogram(
+    'yerba_store_seconds', 'Time spent in workflow store calls')
+DISPATCH_WAIT_SECONDS = registry.histogram(
+    'yerba_dispatch_wait_seconds',
+    'Time from scheduling a job to submitting it by executor')
+TASKS = registry.counter(
+    'yerba_tasks_total', 'Tasks finished by executor and result')
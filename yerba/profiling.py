@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+from cProfile import Profile
+from cStringIO import StringIO
+from functools import wraps
+from logging import getLogger
+import os
+import pstats
+import sys
+from threading import Event, Thread, current_thread
+from time import time
+
+from yerba.metrics import registry
+
+logger = getLogger('yerba.profiling')
+
+MAX_WINDOW = 300
+SAMPLE_INTERVAL = 0.005
+SLOW_SPAN = 0.5
+REPORT_LIMIT = 40
+
+SPAN_SECONDS = registry.histogram(
+    'yerba_span_seconds', 'Time spent in traced sections of the scheduler')
+
+#: Spans taking longer than this many seconds are logged
+slow_span = SLOW_SPAN
+
+def span(name):
+    '''Decorates a function to time each call as the named span'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kw):
+            start = time()
+
+            try:
+                return func(*args, **kw)
+            finally:
+                elapsed = time() - start
+                SPAN_SECONDS.observe(elapsed, span=name)
+
+                if elapsed >= slow_span:
+                    logger.warn("SPAN %s took %.3f seconds", name, elapsed)
+        return wrapper
+    return decorator
+
+def _stack(frame):
+    '''Returns the functions of the frame from the outermost call'''
+    stack = []
+
+    while frame is not None:
+        code = frame.f_code
+        stack.append("%s:%s" % (code.co_filename.rsplit('/', 1)[-1],
+                                code.co_name))
+        frame = frame.f_back
+
+    stack.reverse()
+    return ';'.join(stack)
+
+class Sampler(Thread):
+    """Counts the stacks of every other thread at a fixed interval"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        Thread.__init__(self, name="yerba-sampler")
+        self.daemon = True
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.done = Event()
+
+    def run(self):
+        own = current_thread().ident
+
+        while not self.done.wait(self.interval):
+            for (ident, frame) in sys._current_frames().items():
+                if ident == own:
+                    continue
+
+                stack = _stack(frame)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+            self.samples += 1
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+class Profiler(object):
+    """
+    Profiles the daemon for a bounded window.
+
+    In profile mode cProfile records every call made on the scheduler
+    thread. In sample mode the stacks of every thread are sampled, which
+    costs less and also covers the request workers. Stats are only written
+    to files of the configured directory.
+    """
+
+    def __init__(self, directory=None):
+        #: Directory the stats are written to, None disables writing them
+        self.directory = directory
+        self.mode = None
+        self.profile = None
+        self.sampler = None
+        self.deadline = None
+        self.path = None
+        self.result = None
+
+    @property
+    def running(self):
+        return self.mode is not None
+
+    def start(self, mode='profile', seconds=10, path=None):
+        '''Starts profiling and returns whether it was started'''
+        if self.running or mode not in ('profile', 'sample'):
+            return False
+
+        seconds = max(0, min(float(seconds), MAX_WINDOW))
+        self.mode = mode
+        self.deadline = time() + seconds
+        self.path = path
+        self.result = None
+
+        if mode == 'profile':
+            self.profile = Profile()
+            self.profile.enable()
+        else:
+            self.sampler = Sampler()
+            self.sampler.start()
+
+        logger.info("PROFILER: %s started for %s seconds", mode, seconds)
+        return True
+
+    def resolve(self, name):
+        '''
+        Returns the path of the named file in the directory
+
+        Returns None when no directory is configured or the name is not a
+        plain file name.
+        '''
+        if not self.directory or not name:
+            return None
+
+        if name in (os.curdir, os.pardir) or os.path.basename(name) != name:
+            return None
+
+        return os.path.join(self.directory, name)
+
+    def tick(self):
+        '''Stops profiling once the window has passed'''
+        if self.running and time() >= self.deadline:
+            self.stop()
+
+    def stop(self):
+        '''Stops profiling and keeps the aggregated stats'''
+        if not self.running:
+            return
+
+        if self.mode == 'profile':
+            self.profile.disable()
+            self.result = pstats.Stats(self.profile, stream=StringIO())
+            self.profile = None
+        else:
+            self.sampler.stop()
+            self.result = self.sampler
+            self.sampler = None
+
+        logger.info("PROFILER: %s stopped", self.mode)
+        mode = self.mode
+        self.mode = None
+
+        if self.path:
+            self._dump(mode, self.path)
+
+    def report(self, sort='cumulative', limit=REPORT_LIMIT):
+        '''Returns the aggregated stats of the last window as text'''
+        if self.result is None:
+            return None
+
+        if isinstance(self.result, Sampler):
+            stacks = sorted(self.result.stacks.items(),
+                            key=lambda item: -item[1])[:limit]
+            lines = ["%s samples" % self.result.samples]
+            lines.extend("%6d %s" % (count, stack) for (stack, count) in stacks)
+            return '\n'.join(lines)
+
+        stream = StringIO()
+        self.result.stream = stream
+
+        try:
+            self.result.sort_stats(sort)
+        except KeyError:
+            self.result.sort_stats('cumulative')
+
+        self.result.print_stats(limit)
+        return stream.getvalue()
+
+    def _dump(self, mode, path):
+        '''Writes the stats of the window to the path'''
+        try:
+            if mode == 'profile':
+                self.result.dump_stats(path)
+            else:
+                #: Collapsed stacks as used by flame graph tools
+                with open(path, 'w') as fp:
+                    for (stack, count) in self.result.stacks.items():
+                        fp.write("%s %s\n" % (stack, count))
+        except (IOError, OSError):
+            logger.exception("PROFILER: the stats could not be written to %s",
+                             path)
+
+#: Profiler of the daemon
+profiler = Profiler()
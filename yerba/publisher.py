@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import json
+from logging import getLogger
+
+import zmq
+
+from yerba.core import status_name, DONE_STATUS
+
+logger = getLogger('yerba.publisher')
+
+class EventPublisher(object):
+    """
+    Publishes the changes of workflows and their jobs on a PUB socket.
+
+    Each event is sent as a [topic, body] message where the topic is the
+    workflow id followed by a colon, so that a client subscribing to "12:"
+    only receives the events of workflow 12. The body is a json object
+    with the id, status and cursor of the workflow and the jobs that
+    changed.
+    """
+
+    def __init__(self, context, address):
+        self.socket = context.socket(zmq.PUB)
+        self.socket.set(zmq.LINGER, 0)
+        self.socket.bind(address)
+        #: workflow id -> last status published
+        self.statuses = {}
+        logger.info("PUBLISHER: publishing events on %s", address)
+
+    def publish(self, workflow_id, workflow, changes):
+        '''Publishes the (position, job) changes of the workflow'''
+        status = workflow.status
+
+        if not changes and self.statuses.get(workflow_id) == status:
+            return
+
+        if status in DONE_STATUS:
+            self.statuses.pop(workflow_id, None)
+        else:
+            self.statuses[workflow_id] = status
+
+        body = {
+            "id" : workflow_id,
+            "status" : status_name(status),
+            "cursor" : workflow.cursor,
+            "jobs" : [{"position" : position,
+                       "status" : job.status,
+                       "description" : job.description}
+                      for (position, job) in changes]
+        }
+
+        try:
+            self.socket.send_multipart([b"%d:" % workflow_id,
+                                        json.dumps(body)], zmq.NOBLOCK)
+        except zmq.ZMQError:
+            logger.warn("PUBLISHER: event of workflow %s was dropped",
+                        workflow_id)
+
+    def close(self):
+        '''Closes the socket'''
+        self.socket.close()
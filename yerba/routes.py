@@ -1,22 +1,53 @@
 # -*- coding: utf-8 -*-
 from yerba import utils
+from yerba.metrics import REQUEST_SECONDS, REQUEST_ERRORS
 
 ROUTES = {}
+READONLY_ROUTES = set()
+BATCH_ROUTE = "batch"
 
-def route(request):
-    '''Returns the request as a new endpoint.'''
+def route(request, readonly=False):
+    '''
+    Returns the request as a new endpoint.
+
+    Read-only endpoints do not modify the job engine and may be served
+    concurrently from the worker pool.
+    '''
     def callback(func):
         ROUTES[request] = func
+
+        if readonly:
+            READONLY_ROUTES.add(request)
+
+        return func
     return callback
 
+def is_readonly(request):
+    '''Returns whether the request can be served from the worker pool.'''
+    with utils.ignored(KeyError, TypeError, AttributeError):
+        if request['request'] == BATCH_ROUTE:
+            return all(item['request'] != BATCH_ROUTE and is_readonly(item)
+                       for item in request['data']['requests'])
+
+        return request['request'] in READONLY_ROUTES
+
+    return False
+
 def dispatch(request):
     '''Dispatches request to given route'''
-    with utils.ignored(KeyError):
+    try:
         endpoint = request['request']
         data = request['data']
-        return ROUTES[endpoint](data)
+        callback = ROUTES[endpoint]
+    except (KeyError, TypeError):
+        raise RouteNotFound("The request could not be routed.")
 
-    raise RouteNotFound("The request could not be routed.")
+    with REQUEST_SECONDS.time(route=endpoint):
+        try:
+            return callback(data)
+        except Exception:
+            REQUEST_ERRORS.inc(route=endpoint)
+            raise
 
 class RouteNotFound(utils.YerbaError):
     '''Exception raised when a dispatch route is not found.'''
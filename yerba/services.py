@@ -1,18 +1,462 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict, defaultdict, deque
+from datetime import datetime
 from logging import getLogger
+from os.path import basename
+from time import time
+from zlib import crc32
+
+from yerba.core import INPUTS_MISSING, TASK_DONE
+from yerba.metrics import DISPATCH_WAIT_SECONDS, TASKS
+from yerba.profiling import span
 
 logger = getLogger('yerba.services')
 
+DISPATCH_SIZE = 100
+DATE_FORMAT = "%d/%m/%y at %I:%M:%S%p"
+
+#: Policies choosing the executor of a group that runs a job
+ROUTING = ('load', 'priority', 'affinity')
+
+#: Name of the work_queue executor and of its configuration section
+WORKQUEUE = "workqueue"
+
+def _priority(value):
+    '''Returns the priority as an integer'''
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def _rejected_info(job, error):
+    '''Returns the task info of a job whose task could not be started'''
+    now = datetime.now().strftime(DATE_FORMAT)
+
+    return {
+        'cmd' : str(job),
+        'started' : now,
+        'ended' : now,
+        'elapsed' : 0,
+        'taskid' : None,
+        'returned' : -1,
+        'output' : repr("The task could not be started: %s" % error),
+    }
+
 class Service(object):
     def initialize(self):
         '''Initializes the service'''
 
     def update(self):
-        '''Update callback performed by the service.'''
+        '''
+        Update callback performed by the service.
+
+        Returns True when work was done so that the service is updated again
+        within the same loop turn.
+        '''
 
     def stop(self):
         '''Stops the service'''
 
+class Executor(Service):
+    """
+    A service running the jobs of workflows as tasks.
+
+    Jobs are queued per workflow and submitted by a fair share dispatcher
+    while the executor has room for them. Jobs with the same key share a
+    single task. Jobs whose task could not be started are reported as
+    failed on the next update.
+
+    Subclasses start a task for a job with _run(job, name, priority), which
+    returns its taskid, remove a task with _cancel_task(taskid), which returns
+    whether it was removed, and report whether they can take another task
+    with hungry().
+    """
+    group = "scheduler"
+
+    def __init__(self, notifier, max_tasks=0, dispatch_size=DISPATCH_SIZE):
+        #: taskid -> (job, workflow id -> job of the workflow) run by the task
+        self.tasks = {}
+        #: job key -> taskid used to deduplicate jobs across workflows
+        self.task_keys = {}
+        #: workflow id -> taskids owned by the workflow
+        self.workflow_tasks = defaultdict(set)
+        #: workflow id -> (time queued, job) waiting to be submitted
+        self.pending = OrderedDict()
+        #: (workflow id, job, info) of jobs whose task could not be started
+        self.rejected = []
+        self.priorities = {}
+        self.limits = {}
+        self.notifier = notifier
+        self.max_tasks = max_tasks
+        self.dispatch_size = dispatch_size
+        self.project = self.name
+        #: Lowest workflow priority this executor serves within its group
+        self.min_priority = 0
+        #: Counts the tasks of a workflow against its limit, a router counts
+        #: them on every executor it routes to
+        self.count_tasks = self.task_count
+
+    def hungry(self):
+        '''Returns whether the executor can take another task'''
+        return True
+
+    def capacity(self):
+        '''Returns the number of tasks the executor runs at once'''
+        return 1
+
+    def task_count(self, name):
+        '''Returns the number of tasks the workflow runs on this executor'''
+        return len(self.workflow_tasks.get(name, ()))
+
+    def load(self, extra=0):
+        '''
+        Returns the tasks running or waiting per unit of capacity, counting
+        extra jobs that are about to be scheduled
+        '''
+        waiting = sum(len(pending) for pending in self.pending.values())
+        outstanding = len(self.tasks) + waiting + extra
+        return outstanding / float(max(1, self.capacity()))
+
+    @span('workqueue.schedule')
+    def schedule(self, iterable, name, priority=None, limit=None):
+        '''
+        Schedules jobs to be run
+
+        Jobs are queued per workflow and submitted by the fair share
+        dispatcher. The limit caps the number of concurrent tasks of the
+        workflow, zero or None uses the configured default.
+        '''
+        logger.info("######### WORKQUEUE SCHEDULING ##########")
+        waiting = []
+        pending = self.pending.setdefault(name, deque())
+        queued = time()
+        self.priorities[name] = _priority(priority)
+        self.limits[name] = limit or self.max_tasks
+
+        for new_job in iterable:
+            logger.info('WORKQUEUE %s: The workflow %s is scheduling job %s', self.project, name, new_job)
+
+            if not new_job.ready():
+                logger.info('WORKFLOW %s: Job %s was not scheduled waiting on inputs', name, new_job)
+                waiting.append(new_job)
+                continue
+
+            if not self._attach(new_job, name):
+                pending.append((queued, new_job))
+
+        if not pending:
+            self._forget(name)
+
+        self._dispatch()
+
+        #: Return the jobs to the workflow to wait on their inputs
+        if waiting:
+            self.notifier.notify(INPUTS_MISSING, name, waiting)
+
+        logger.info("######### WORKQUEUE END SCHEDULING ##########")
+
+    def _attach(self, new_job, name):
+        '''
+        Attaches the workflow to an existing task running the same job.
+
+        A workflow that was reloaded while the task runs replaces the job of
+        its previous instance. Returns whether a task was found.
+        '''
+        taskid = self.task_keys.get(new_job.key)
+
+        if taskid is None:
+            return False
+
+        (job, jobs) = self.tasks[taskid]
+        jobs[name] = new_job
+        self.workflow_tasks[name].add(taskid)
+
+        logger.info(('WORKQUEUE %s: This job has already been'
+            'assigned to task %s'), self.project, taskid)
+        return True
+
+    @span('workqueue.dispatch')
+    def _dispatch(self):
+        '''
+        Submits pending jobs while the executor is hungry.
+
+        Workflows are visited in order of priority and take turns submitting
+        one job each, so a large workflow cannot starve smaller ones.
+        Workflows at their concurrent task limit are passed over.
+        Returns the number of tasks submitted.
+        '''
+        submitted = 0
+
+        while self.pending and submitted < self.dispatch_size:
+            turn = sorted(self.pending.keys(),
+                          key=lambda name: -self.priorities[name])
+            progress = False
+
+            for name in turn:
+                if not self.hungry() or submitted >= self.dispatch_size:
+                    return submitted
+
+                limit = self.limits[name]
+
+                if limit and self.count_tasks(name) >= limit:
+                    continue
+
+                priority = self.priorities[name]
+                pending = self.pending.pop(name)
+                (queued, new_job) = pending.popleft()
+                progress = True
+
+                #: Move the workflow to the back of its priority class
+                if pending:
+                    self.pending[name] = pending
+                else:
+                    self._forget(name)
+
+                if not self._attach(new_job, name):
+                    if self._submit(new_job, name, priority):
+                        DISPATCH_WAIT_SECONDS.observe(time() - queued,
+                                                      executor=self.name)
+
+                    submitted += 1
+
+            if not progress:
+                break
+
+        return submitted
+
+    def _forget(self, name):
+        '''Removes the workflow from the dispatcher'''
+        self.pending.pop(name, None)
+        self.priorities.pop(name, None)
+        self.limits.pop(name, None)
+
+    def _submit(self, new_job, name, priority=0):
+        '''
+        Starts a task for the job at the priority of its workflow and
+        indexes it
+
+        Returns whether the task was started, a job whose task could not be
+        started is kept to be reported as failed.
+        '''
+        try:
+            new_id = self._run(new_job, name, priority)
+        except Exception as error:
+            logger.exception('WORKQUEUE %s: The task of job %s could not be '
+                             'started', self.project, new_job)
+            self.rejected.append((name, new_job,
+                                  _rejected_info(new_job, error)))
+            return False
+
+        logger.info('WORKQUEUE %s: Task has been submited and assigned [id %s]', self.project, new_id)
+
+        self.tasks[new_id] = (new_job, OrderedDict([(name, new_job)]))
+        self.task_keys[new_job.key] = new_id
+        self.workflow_tasks[name].add(new_id)
+        return True
+
+    def _finish(self, taskid, info, finished):
+        '''
+        Removes the finished task and adds its jobs to the finished results
+        of each workflow
+
+        Each workflow is given its own copy of the task info.
+        '''
+        jobs = self._remove_task(taskid)
+        info['executor'] = self.name
+        TASKS.inc(result='completed' if info['returned'] == 0 else 'failed',
+                  executor=self.name)
+
+        for (workflow, job) in jobs.items():
+            job.invalidate()
+            finished.setdefault(workflow, []).append((job, dict(info)))
+
+    def _reject(self, finished):
+        '''
+        Adds the jobs whose task could not be started to the finished
+        results of their workflow and returns their number
+        '''
+        (rejected, self.rejected) = (self.rejected, [])
+
+        for (name, job, info) in rejected:
+            info['executor'] = self.name
+            TASKS.inc(result='failed', executor=self.name)
+            finished.setdefault(name, []).append((job, info))
+
+        return len(rejected)
+
+    def _notify(self, finished):
+        '''Notifies each workflow once with all of its finished jobs'''
+        for (workflow, results) in finished.items():
+            self.notifier.notify(TASK_DONE, workflow, results)
+
+    def cancel(self, name):
+        '''
+        Removes the jobs based on there job id task id from the queue.
+        '''
+        self._forget(name)
+        self.rejected = [item for item in self.rejected if item[0] != name]
+
+        for taskid in self.workflow_tasks.pop(name, ()):
+            (job, jobs) = self.tasks[taskid]
+
+            logger.info('WORKFLOW %s: Requesting task %s to be cancelled',
+                    name, taskid)
+
+            del jobs[name]
+
+            if not jobs:
+                if self._cancel_task(taskid):
+                    self._remove_task(taskid)
+                    logger.info("WORKQUEUE %s: The task %s was cancelled",
+                        self.project, taskid)
+                else:
+                    logger.error("WORKQUEUE %s: failed to cancel %s",
+                        self.project, taskid)
+            else:
+                msg = ('WORKQUEUE %s: The task %s was not cancelled '
+                        'workflows %s depend on the task')
+                logger.info(msg, self.project, taskid, ', '.join(map(str, jobs)))
+
+    def _remove_task(self, taskid):
+        '''
+        Removes the task from the indices and returns the job of each
+        workflow
+        '''
+        (job, jobs) = self.tasks.pop(taskid)
+        self.task_keys.pop(job.key, None)
+
+        for name in jobs:
+            taskids = self.workflow_tasks.get(name)
+
+            if taskids is not None:
+                taskids.discard(taskid)
+
+                if not taskids:
+                    del self.workflow_tasks[name]
+
+        return jobs
+
+class ExecutorRouter(object):
+    """
+    Routes the jobs of workflows to executors.
+
+    A job runs on the executor named by its executor option, then on the
+    executor routed for its command and otherwise on the default executor.
+    Names of executors that are not running fall back to the default.
+
+    A name may also refer to a group of executors. A job already running
+    on an executor of the group is attached to it, otherwise the routing
+    policy picks one among the executors whose min_priority the workflow
+    meets. The concurrent task limit of a workflow holds across every
+    executor of the router. A job being retried avoids the executor it
+    failed on:
+
+        load      the least loaded executor
+        priority  the least loaded of the executors with the highest
+                  min_priority
+        affinity  the same executor for every job of a workflow
+    """
+
+    def __init__(self, default, routing='load'):
+        if routing not in ROUTING:
+            raise ValueError("unknown routing %s" % routing)
+
+        self.default = default
+        self.routing = routing
+        #: executor name -> executor
+        self.executors = OrderedDict()
+        #: group name -> executors
+        self.groups = OrderedDict()
+        #: command basename -> executor name
+        self.commands = {}
+
+    def add(self, executor, commands=(), group=None):
+        '''Adds the executor to the group and routes the commands to it'''
+        self.executors[executor.name] = executor
+        executor.count_tasks = self.task_count
+
+        if group:
+            self.groups.setdefault(group, []).append(executor)
+
+        for command in commands:
+            self.commands[basename(command)] = executor.name
+
+    def task_count(self, name):
+        '''Returns the number of tasks the workflow runs on every executor'''
+        return sum(executor.task_count(name)
+                   for executor in self.executors.values())
+
+    def _members(self, name):
+        '''Returns the executors of the name or None if it is unknown'''
+        if name in self.groups:
+            return self.groups[name]
+
+        if name in self.executors:
+            return [self.executors[name]]
+
+        return None
+
+    def route(self, job, name=None, priority=0, assigned=None):
+        '''
+        Returns the executor of the job for the workflow name
+
+        The assigned mapping counts the jobs already routed to each
+        executor that have not been scheduled yet.
+        '''
+        target = (job.options.executor or
+                  self.commands.get(basename(job.cmd)) or self.default)
+        members = self._members(target) or self._members(self.default)
+
+        if len(members) == 1:
+            return members[0]
+
+        for executor in members:
+            if job.key in executor.task_keys:
+                return executor
+
+        eligible = [executor for executor in members
+                    if executor.min_priority <= priority] or members
+
+        #: Retry a failed job on another executor where there is one
+        if job.attempts > 1:
+            failed_on = job.info.get('executor')
+            eligible = [executor for executor in eligible
+                        if executor.name != failed_on] or eligible
+
+        if self.routing == 'affinity':
+            return eligible[crc32(str(name)) % len(eligible)]
+
+        if self.routing == 'priority':
+            highest = max(executor.min_priority for executor in eligible)
+            eligible = [executor for executor in eligible
+                        if executor.min_priority == highest]
+
+        if assigned is None:
+            assigned = {}
+
+        return min(eligible,
+                   key=lambda executor: executor.load(
+                       assigned.get(executor.name, 0)))
+
+    def schedule(self, iterable, name, priority=None, limit=None):
+        '''Schedules each job on the executor it is routed to'''
+        routed = OrderedDict()
+        assigned = {}
+        level = _priority(priority)
+
+        for job in iterable:
+            executor = self.route(job, name, level, assigned)
+            routed.setdefault(executor, []).append(job)
+            assigned[executor.name] = assigned.get(executor.name, 0) + 1
+
+        for (executor, jobs) in routed.items():
+            executor.schedule(jobs, name, priority=priority, limit=limit)
+
+    def cancel(self, name):
+        '''Cancels the tasks of the workflow on every executor'''
+        for executor in self.executors.values():
+            executor.cancel(name)
+
 class InitializeServiceException(Exception):
     """Exception raised when a service fails to initialize properly."""
     pass
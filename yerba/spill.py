@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from logging import getLogger
+import os
+import zlib
+
+from yerba.utils import ignored
+
+logger = getLogger('yerba.spill')
+
+MAX_HANDLES = 64
+LEVEL = 6
+
+class OutputStore(object):
+    """
+    Keeps the output of tasks in a compressed file per workflow.
+
+    Each output is compressed and appended to the file of its workflow.
+    Only a "<workflow id>:<offset>:<length>" reference and the size of the
+    output are kept in the job info. Output is kept in the job info when
+    no directory was configured.
+    """
+
+    def __init__(self, path=None, max_handles=MAX_HANDLES, level=LEVEL):
+        self.path = path
+        self.max_handles = max_handles
+        self.level = level
+        #: workflow id -> open file in least recently used order
+        self.handles = OrderedDict()
+
+    def configure(self, path=None, max_handles=None, level=None):
+        '''Sets the directory of the spill files and the limits'''
+        if path is not None:
+            with ignored(OSError):
+                os.makedirs(path)
+
+            self.close()
+            self.path = path
+
+        if max_handles is not None:
+            self.max_handles = max_handles
+
+        if level is not None:
+            self.level = level
+
+    def spill(self, workflow_id, info):
+        '''Moves the output of the task info to the file of the workflow'''
+        if not self.path or info.get('output') is None:
+            return
+
+        output = info.pop('output')
+        data = output
+
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+
+        try:
+            handle = self._open(workflow_id)
+            handle.seek(0, os.SEEK_END)
+            offset = handle.tell()
+            compressed = zlib.compress(data, self.level)
+            handle.write(compressed)
+            handle.flush()
+        except (IOError, OSError):
+            logger.warn("SPILL: the output of workflow %s could not be "
+                        "written", workflow_id)
+            self._close(workflow_id)
+            info['output'] = output
+            return
+
+        info['output_ref'] = "%s:%s:%s" % (workflow_id, offset,
+                                           len(compressed))
+        info['output_size'] = len(data)
+
+    def read(self, reference):
+        '''Returns the output for the reference or None if it is missing'''
+        try:
+            (workflow_id, offset, length) = reference.split(':')
+
+            with open(self._filename(workflow_id), 'rb') as fp:
+                fp.seek(int(offset))
+                return zlib.decompress(fp.read(int(length)))
+        except (AttributeError, ValueError, IOError, OSError, zlib.error):
+            return None
+
+    def remove(self, workflow_id):
+        '''Removes the outputs of the workflow'''
+        if not self.path:
+            return
+
+        self._close(workflow_id)
+
+        with ignored(OSError):
+            os.remove(self._filename(workflow_id))
+
+    def close(self):
+        '''Closes every file'''
+        for workflow_id in list(self.handles):
+            self._close(workflow_id)
+
+    def _filename(self, workflow_id):
+        '''Returns the spill file of the workflow'''
+        return os.path.join(self.path, "%s.out" % int(workflow_id))
+
+    def _open(self, workflow_id):
+        '''Returns the open spill file of the workflow'''
+        handle = self.handles.pop(workflow_id, None)
+
+        if handle is None:
+            while len(self.handles) >= self.max_handles:
+                (_, oldest) = self.handles.popitem(last=False)
+
+                with ignored(IOError, OSError):
+                    oldest.close()
+
+            handle = open(self._filename(workflow_id), 'ab')
+
+        self.handles[workflow_id] = handle
+        return handle
+
+    def _close(self, workflow_id):
+        '''Closes the spill file of the workflow if it is open'''
+        handle = self.handles.pop(workflow_id, None)
+
+        if handle is not None:
+            with ignored(IOError, OSError):
+                handle.close()
+
+#: Store shared by every workflow in the daemon
+output_store = OutputStore()
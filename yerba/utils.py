@@ -3,7 +3,8 @@ from contextlib import contextmanager
 from functools import wraps
 import logging
 import os
-import UserDict
+
+from yerba.fs import stat_cache
 
 @contextmanager
 def ignored(*exceptions):
@@ -20,21 +21,6 @@ def meminfo():
         return dict([[item.strip() for item in line.rstrip("\n").split(":")]
             for line in fp])
 
-class ChainMap(UserDict.DictMixin):
-    def __init__(self, *maps):
-        self._maps = maps
-
-    def __getitem__(self, key):
-        for mapping in self._maps:
-            with ignored(KeyError):
-                item = mapping[key]
-                return item
-
-        raise KeyError(key)
-
-    def __setitem__(self, key, value):
-        self._maps[0][key] = value
-
 class YerbaError(Exception):
     def __init__(self, msg):
         self._msg = msg
@@ -48,10 +34,7 @@ def is_empty(path):
     If the path is not a valid file an OSError
     will be raised.
     """
-    if not os.path.isfile(path):
-        raise OSError(2, "No such file", path)
-
-    return os.stat(path)[6] == 0
+    return stat_cache.is_empty(os.path.abspath(path))
 
 def log_on_exception(exception, message, logger=logging.getLogger()):
     """
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
+from errno import EAGAIN, EINTR
+from logging import getLogger
+import os
+import struct
+import sys
+from time import time
+
+from yerba.core import INPUTS_READY
+from yerba.fs import stat_cache
+from yerba.services import Service
+
+logger = getLogger('yerba.watcher')
+
+POLL_INTERVAL = 30
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+EVENT_HEADER = struct.Struct('iIII')
+
+class Inotify(object):
+    """
+    A minimal non-blocking interface to the linux inotify api
+    """
+
+    def __init__(self):
+        self.libc = CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(get_errno(), "inotify could not be initialized")
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """
+        Watches the directory and returns the watch descriptor
+        """
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding())
+
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+
+        if wd < 0:
+            raise OSError(get_errno(), "inotify could not watch", path)
+
+        return wd
+
+    def rm_watch(self, wd):
+        """
+        Removes the watch descriptor
+        """
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """
+        Returns the set of watch descriptors that received events
+        """
+        changed = set()
+
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (EAGAIN, EINTR):
+                    break
+                raise
+
+            if not data:
+                break
+
+            offset = 0
+
+            while offset + EVENT_HEADER.size <= len(data):
+                (wd, _, _, length) = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size + length
+                changed.add(wd)
+
+        return changed
+
+    def close(self):
+        """
+        Closes the inotify descriptor
+        """
+        os.close(self.fd)
+
+def _nearest_directory(path):
+    """Returns the closest existing directory containing the path"""
+    directory = os.path.dirname(path)
+
+    while directory and not os.path.isdir(directory):
+        parent = os.path.dirname(directory)
+
+        if parent == directory:
+            break
+
+        directory = parent
+
+    return directory
+
+class InputWatcher(Service):
+    """
+    Wakes workflows when the inputs they are waiting on appear.
+
+    Missing inputs are watched through inotify on the nearest existing
+    directory. Every watched path is also polled at a low frequency for
+    filesystems where inotify does not report changes, such as NFS.
+    """
+    name = "watcher"
+    group = "monitor"
+
+    def __init__(self, config, notifier):
+        self.notifier = notifier
+        self.interval = float(config.get('poll-interval', POLL_INTERVAL))
+        self.use_inotify = str(config.get('inotify', True)).lower() in (
+            'true', '1', 'yes', 'on')
+        self.inotify = None
+        self.previous = time()
+
+        #: path -> workflow ids waiting on the path
+        self.paths = {}
+        #: workflow id -> (paths, deadline)
+        self.workflows = {}
+        #: directory -> (watch descriptor, paths)
+        self.directories = {}
+        #: watch descriptor -> directory
+        self.watches = {}
+        #: path -> directory watched for the path
+        self.placements = {}
+
+    def initialize(self):
+        '''Starts inotify if it is available'''
+        if not self.use_inotify:
+            return
+
+        try:
+            self.inotify = Inotify()
+        except (OSError, AttributeError):
+            logger.warn("WATCHER: inotify is not available, polling every %s "
+                        "seconds", self.interval)
+
+    def stop(self):
+        '''Stops watching all paths'''
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+
+    def watch(self, workflow_id, paths, deadline=None):
+        '''
+        Watches the paths the workflow is waiting on.
+
+        The workflow is woken when one of the paths appears or once the
+        deadline has passed. Previous watches of the workflow are replaced.
+        '''
+        self.unwatch(workflow_id)
+
+        if not paths and deadline is None:
+            return
+
+        self.workflows[workflow_id] = (set(paths), deadline)
+
+        for path in paths:
+            if path not in self.paths:
+                self.paths[path] = set()
+                self._place(path)
+
+            self.paths[path].add(workflow_id)
+
+        logger.debug("WATCHER: workflow %s is waiting on %s inputs",
+                     workflow_id, len(paths))
+
+    def unwatch(self, workflow_id):
+        '''Stops watching the paths of the workflow'''
+        (paths, _) = self.workflows.pop(workflow_id, ((), None))
+
+        for path in paths:
+            owners = self.paths.get(path)
+
+            if owners is None:
+                continue
+
+            owners.discard(workflow_id)
+
+            if not owners:
+                del self.paths[path]
+                self._displace(path)
+
+    def update(self):
+        '''
+        Wakes the workflows whose inputs appeared or whose deadline passed.
+        '''
+        now = time()
+        appeared = set()
+
+        if self.inotify:
+            for wd in self.inotify.read():
+                directory = self.watches.get(wd)
+
+                if directory in self.directories:
+                    appeared.update(self._check(self.directories[directory][1]))
+
+        if now - self.previous >= self.interval:
+            self.previous = now
+            appeared.update(self._check(self.paths.keys()))
+
+        woken = set()
+
+        for path in appeared:
+            woken.update(self.paths.get(path, ()))
+
+        for (workflow_id, (_, deadline)) in self.workflows.items():
+            if deadline is not None and deadline <= now:
+                woken.add(workflow_id)
+
+        for workflow_id in woken:
+            self.unwatch(workflow_id)
+            self.notifier.notify(INPUTS_READY, workflow_id)
+
+        return len(woken) > 0
+
+    def _check(self, paths):
+        '''Returns the paths that exist and re-places watches for the rest'''
+        appeared = []
+
+        for path in list(paths):
+            stat_cache.invalidate(path)
+
+            if stat_cache.stat(path) is not None:
+                appeared.append(path)
+            elif (self.inotify and
+                    self.placements.get(path) != _nearest_directory(path)):
+                #: A parent directory was created since the path was placed
+                self._displace(path)
+                self._place(path)
+
+        return appeared
+
+    def _place(self, path):
+        '''Adds an inotify watch on the nearest directory of the path'''
+        if not self.inotify:
+            return
+
+        directory = _nearest_directory(path)
+
+        if directory not in self.directories:
+            try:
+                wd = self.inotify.add_watch(directory)
+            except OSError:
+                logger.warn("WATCHER: unable to watch %s", directory)
+                return
+
+            self.directories[directory] = (wd, set())
+            self.watches[wd] = directory
+
+        self.directories[directory][1].add(path)
+        self.placements[path] = directory
+
+    def _displace(self, path):
+        '''Removes the path from its inotify watch'''
+        directory = self.placements.pop(path, None)
+
+        if directory not in self.directories:
+            return
+
+        (wd, paths) = self.directories[directory]
+        paths.discard(path)
+
+        if not paths:
+            del self.directories[directory]
+            del self.watches[wd]
+
+            if self.inotify:
+                self.inotify.rm_watch(wd)
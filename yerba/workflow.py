@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
-from itertools import groupby
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import count, groupby
 import logging
 import os
+from time import time
 
 from yerba import core
 from yerba import db
 from yerba import utils
+from yerba.fs import stat_cache
+from yerba.logwriter import log_writer
+from yerba.profiling import span
 
 logger = logging.getLogger('yerba.workflow')
 
@@ -17,11 +23,23 @@ FAILED = 'failed'
 CANCELLED = 'cancelled'
 STOPPED = 'stopped'
 SKIPPED = 'skipped'
+RETRYING = 'retrying'
 
 READY_STATES = frozenset([WAITING, SCHEDULED])
-RUNNING_STATES = frozenset([WAITING, SCHEDULED, RUNNING])
+RUNNING_STATES = frozenset([WAITING, SCHEDULED, RUNNING, RETRYING])
 FINISHED_STATES = frozenset([STOPPED, CANCELLED, FAILED, COMPLETED, SKIPPED])
 
+#: Estimated bytes held by a job besides its strings
+JOB_FOOTPRINT = 2048
+
+#: Seconds before the first retry of a failed job, doubled for each retry
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 600
+
+#: Sequence numbers stamped on job changes, starting from the time in
+#: microseconds so that they keep increasing across restarts
+_sequence = count(int(time() * 1000000))
+
 def _format_args(args):
     """Returns given a list of args returns an argument string"""
     argstring = ""
@@ -36,11 +54,49 @@ def _format_args(args):
 
     return argstring
 
+def _path(item):
+    """Returns the absolute path of an input or output entry"""
+    if isinstance(item, list):
+        item = item[0]
+
+    return os.path.abspath(str(item))
+
+def _exists(items, allow_zero_length=True):
+    """
+    Returns whether every file or directory entry exists.
+
+    Directories are entries given as [path, 1]. Files must not be empty
+    unless zero length files are allowed.
+    """
+    paths = [_path(item) for item in items]
+    stat_cache.prefetch(paths)
+
+    for (item, path) in zip(items, paths):
+        if isinstance(item, list) and item[1]:
+            if not stat_cache.isdir(path):
+                return False
+        elif not stat_cache.isfile(path):
+            return False
+        elif not allow_zero_length and stat_cache.is_empty(path):
+            return False
+
+    return True
+
+def _intern(item, paths):
+    """Returns the entry with its path shared through the paths table"""
+    if isinstance(item, list):
+        return [paths.setdefault(item[0], item[0])] + item[1:]
+
+    return paths.setdefault(item, item)
+
+def _freeze(item):
+    """Returns a hashable copy of an input or output entry"""
+    if isinstance(item, list):
+        return tuple(item)
+
+    return item
+
 
-@utils.log_on_exception(OSError, "The job could not be written to the log.",
-                         logger=logger)
-@utils.log_on_exception(IOError, "The job could not be written to the log.",
-                         logger=logger)
 def log_job_info(log_file, job):
     '''Log the results of a job'''
     outputs = []
@@ -63,62 +119,110 @@ def log_job_info(log_file, job):
 
     job.info['outputs'] = ', '.join(outputs)
     description = '{0}\n'.format(job.description)
-    body = msg.format(**job.info)
-
-    with open(log_file, 'a') as log_handle:
-        log_handle.write('#' * 25 + '\n')
-        log_handle.write(description)
-        log_handle.write(body)
-        log_handle.write('#' * 25 + '\n\n')
-
-@utils.log_on_exception(OSError, "The job could not be written to the log.",
-                         logger=logger)
-@utils.log_on_exception(IOError, "The job could not be written to the log.",
-                         logger=logger)
+    fields = dict(job.info)
+    fields.setdefault('output', '')
+    body = msg.format(**fields)
+
+    log_writer.write(log_file, ''.join([
+        '#' * 25 + '\n',
+        description,
+        body,
+        '#' * 25 + '\n\n']))
+
 def log_skipped_job(log_file, job):
     '''Log a job that was skipped'''
-    with open(log_file, 'a') as log_handle:
-        log_handle.write('#' * 25 + '\n')
-        log_handle.write('{0}\n'.format(job.description))
-        log_handle.write("Job: %s\n" % str(job))
-        log_handle.write("Skipped: The analysis was previously generated.\n")
-        log_handle.write('#' * 25 + '\n\n')
-
-@utils.log_on_exception(OSError, "The job could not be written to the log.",
-                         logger=logger)
-@utils.log_on_exception(IOError, "The job could not be written to the log.",
-                         logger=logger)
+    log_writer.write(log_file, ''.join([
+        '#' * 25 + '\n',
+        '{0}\n'.format(job.description),
+        "Job: %s\n" % str(job),
+        "Skipped: The analysis was previously generated.\n",
+        '#' * 25 + '\n\n']))
+
 def log_not_run_job(log_file, job):
     '''Log a job that could not be run'''
+    log_writer.write(log_file, ''.join([
+        '#' * 25 + '\n',
+        '{0}\n'.format(job.description),
+        "Job: %s\n" % str(job),
+        "The job was not run.\n",
+        '#' * 25 + '\n\n']))
+
+class JobOptions(object):
+    """
+    The resolved options of a job.
+
+    Options are immutable and shared by every job with the same values.
+    """
+    __slots__ = ('allow_zero_length', 'retries', 'executor')
+
+    #: option name -> attribute
+    fields = {
+        "allow-zero-length" : 'allow_zero_length',
+        "retries" : 'retries',
+        "executor" : 'executor'
+    }
+
+    #: (allow_zero_length, retries, executor) -> shared options
+    _shared = {}
+
+    def __init__(self, allow_zero_length=True, retries=0, executor=None):
+        self.allow_zero_length = allow_zero_length
+        self.retries = retries
+        self.executor = executor
+
+    @classmethod
+    def resolve(cls, options):
+        '''Returns the shared options overriding the defaults with options'''
+        values = (options.get("allow-zero-length", True),
+                  int(options.get("retries") or 0),
+                  options.get("executor"))
+
+        if values not in cls._shared:
+            cls._shared[values] = cls(*values)
+
+        return cls._shared[values]
 
-    with open(log_file, 'a') as log_handle:
-        log_handle.write('#' * 25 + '\n')
-        log_handle.write('{0}\n'.format(job.description))
-        log_handle.write("Job: %s\n" % str(job))
-        log_handle.write("The job was not run.\n")
-        log_handle.write('#' * 25 + '\n\n')
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+
+        return getattr(self, self.fields[key])
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
 class Job(object):
-    def __init__(self, cmd, script, arguments, description=''):
+    __slots__ = ('cmd', 'script', 'args', 'command', 'description', 'inputs',
+                 'outputs', 'options', 'attempts', '_status', '_info', '_key')
+
+    def __init__(self, cmd, script, arguments, description='', inputs=(),
+                 outputs=(), options=None):
         self.cmd = cmd
         self.script = script
         self.args = arguments
-        self.inputs = []
-        self.outputs = []
-        self._status = SCHEDULED
+        self.command = ' '.join([cmd, arguments])
         self.description = description
-        self._info = {}
-        self._errors = []
+        self.inputs = tuple(sorted(inputs))
+        self.outputs = tuple(sorted(outputs))
+        self.options = options or JobOptions.resolve({})
         self.attempts = 1
-        self._options = {
-            "allow-zero-length" : True,
-            "retries" : 0
-        }
+        self._status = SCHEDULED
+        self._info = None
+        self._key = (self.command,
+                     tuple(sorted(_freeze(fp) for fp in self.inputs)),
+                     tuple(sorted(_freeze(fp) for fp in self.outputs)))
 
     @classmethod
-    def from_object(cls, job_object):
+    def from_object(cls, job_object, overwrite=True, paths=None):
         """
         Returns a job generated from a python object
+
+        The previous outputs are removed when the job asks to overwrite them
+        unless overwrite is False. Paths are shared through the paths table
+        when one is given.
         """
         (cmd, script, args) = (job_object['cmd'], job_object['script'],
                             job_object.get('args', []))
@@ -127,40 +231,31 @@ class Job(object):
 
         # Set the job_object description
         desc = job_object.get('description', '')
-        new_job = cls(cmd, script, arg_string, description=desc)
-        logger.debug("Creating job %s",  new_job.description)
 
         # Set the job_object options
         options = job_object.get('options', {})
         logger.info("Additional job options being set %s", options)
-        new_job.options = filter_options(options)
 
-        # Add inputs
-        inputs = job_object.get('inputs', []) or []
-        new_job.inputs.extend(sorted(inputs))
+        if paths is None:
+            paths = {}
 
-        # Add outputs
+        inputs = job_object.get('inputs', []) or []
         outputs = job_object.get('outputs', []) or []
-        new_job.outputs.extend(sorted(outputs))
 
-        if 'overwrite' in job_object and int(job_object['overwrite']):
+        new_job = cls(cmd, script, arg_string, description=desc,
+                      inputs=[_intern(item, paths) for item in inputs],
+                      outputs=[_intern(item, paths) for item in outputs],
+                      options=JobOptions.resolve(filter_options(options)))
+        logger.debug("Creating job %s",  new_job.description)
+
+        if (overwrite and 'overwrite' in job_object and
+                int(job_object['overwrite'])):
             logger.debug(("The job will overwrite previous"
                 "results:\n%s"), new_job)
             new_job.clear()
 
         return new_job
 
-    @property
-    def options(self):
-        return self._options
-
-    @options.setter
-    def options(self, options):
-        """
-        Updates the options to be used by the job
-        """
-        self._options = utils.ChainMap(options, self._options)
-
     @property
     def status(self):
         return self._status
@@ -172,6 +267,9 @@ class Job(object):
 
     @property
     def info(self):
+        if self._info is None:
+            self._info = {}
+
         return self._info
 
     @info.setter
@@ -188,11 +286,12 @@ class Job(object):
             ['status', self.status],
             ['description', self.description],
             ['cmd',         self.cmd + self.args],  # mdb added 10/13/16
-            ['inputs',      self.inputs],           # mdb added 10/13/16
-            ['outputs',     self.outputs]           # mdb added 10/13/16
+            ['inputs',      list(self.inputs)],     # mdb added 10/13/16
+            ['outputs',     list(self.outputs)]     # mdb added 10/13/16
         ]
 
-        status.extend(self.info.items())
+        if self._info:
+            status.extend(self._info.items())
 
         return dict(status)
 
@@ -202,81 +301,106 @@ class Job(object):
             with utils.ignored(OSError):
                 os.remove(output)
 
+        self.invalidate()
+
+    def invalidate(self):
+        '''Drops the cached state of the outputs of the job'''
+        stat_cache.invalidate(*[_path(fp) for fp in self.outputs])
+
+    def invalidate_inputs(self):
+        '''Drops the cached state of the inputs of the job'''
+        stat_cache.invalidate(*[_path(fp) for fp in self.inputs])
+
     def running(self):
         return self._status == 'running'
 
     def completed(self):
         '''Returns whether or not the job was completed.'''
-
-        for fp in self.outputs:
-            if isinstance(fp, list) and fp[1]:
-                val = os.path.abspath(str(fp[0]))
-
-                if not os.path.isdir(val):
-                    return False
-
-            elif self.options["allow-zero-length"]:
-                path = os.path.abspath(str(fp))
-
-                if not os.path.isfile(path):
-                    return False
-            else:
-                path = os.path.abspath(str(fp))
-                if not os.path.isfile(path) or utils.is_empty(path):
-                    return False
-
-        return True
+        return _exists(self.outputs, self.options.allow_zero_length)
 
     def ready(self):
         '''Returns that the job has its input files and is ready.'''
-        for fp in self.inputs:
-            if isinstance(fp, list) and fp[1]:
-                val = os.path.abspath(str(fp[0]))
-
-                if not os.path.isdir(val):
-                    return False
-            elif self.options["allow-zero-length"]:
-                path = os.path.abspath(str(fp))
-
-                if not os.path.isfile(path):
-                    return False
-            else:
-                path = os.path.abspath(str(fp))
-
-                if not os.path.isfile(path) or utils.is_empty(path):
-                    return False
-
-        return True
+        return _exists(self.inputs, self.options.allow_zero_length)
 
     def restart(self):
         self.attempts = self.attempts + 1
 
     def failed(self):
-        return self.attempts > self.options['retries']
+        return self.attempts > self.options.retries
+
+    @property
+    def key(self):
+        '''
+        Returns the canonical key of the job.
+
+        Jobs with the same command, inputs and outputs share the same key.
+        '''
+        return self._key
 
     def __eq__(self, other):
-        return (sorted(other.inputs) == sorted(self.inputs) and
-                sorted(other.outputs) == sorted(self.outputs) and
-                str(other) == str(self))
+        return isinstance(other, Job) and self._key == other._key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key)
 
     def __repr__(self):
-        return ' '.join([self.cmd, self.args])
+        return self.command
 
     def __str__(self):
-        return repr(self)
+        return self.command
 
 #FIXME: states for jobs should be decoupled from jobs
-#TODO: Add proper dependency management to jobs
 class Workflow(object):
-    def __init__(self, name, jobs, log=None, priority=0):
+    def __init__(self, name, jobs, log=None, priority=0, max_tasks=0):
         self.name = name
         self.log = log
         self.priority = priority
+        self.max_tasks = max_tasks
         self.jobs = tuple(jobs)
-        self.available = jobs
-        self.running = []
+        self.positions = dict((id(job), index)
+                              for (index, job) in enumerate(self.jobs))
+        self.available = OrderedDict((id(job), job) for job in self.jobs)
+        self.changes = OrderedDict()
+        self.ready = []
+        self.waiting = OrderedDict()
+        self.running = OrderedDict()
         self.completed = []
         self.status = core.Status.Initialized
+        self.input_timeout = 0
+        self.stalled_since = None
+        self.retry_delay = RETRY_DELAY
+        self.max_retry_delay = MAX_RETRY_DELAY
+        #: failed jobs waiting out their backoff as (time to run, job)
+        self.retrying = OrderedDict()
+        self._started = False
+        (self.dependents, self.blockers) = _build_graph(self.jobs)
+
+        #: Jobs that have not changed since the workflow was created carry
+        #: its creation stamp
+        self.created = next(_sequence)
+        self.stamps = [self.created] * len(self.jobs)
+        #: (stamp, position) of each change in the order they were made
+        self.history = []
+
+    def find(self, job):
+        '''
+        Returns the job of the workflow matching a job finished by a task
+
+        A task started for a previous instance of the workflow returns the
+        job of that instance, it is matched to the running job with the same
+        key. Returns None when the workflow has no such job.
+        '''
+        if id(job) in self.positions:
+            return job
+
+        for running in self.running.values():
+            if running == job:
+                return running
+
+        return None
 
     def update_status(self, job, info):
         '''Updates the status of the workflow'''
@@ -284,7 +408,7 @@ class Workflow(object):
         job.info = info
 
         #: Remove the job from the running list
-        self.running.remove(job)
+        self.running.pop(id(job), None)
 
         #FIXME: add workflow change events
         #: Update the workflow log
@@ -293,26 +417,34 @@ class Workflow(object):
 
         #: Check that job returned successfully
         if info['returned'] != 0 or not job.completed():
-            job.status = FAILED
+            #: Run the job again unless it is out of retries
+            if self.status not in core.DONE_STATUS and not job.failed():
+                return self._retry(job)
+
+            self._change(job, FAILED)
             self._failed()
             self.completed.append(job)
             self.status = core.Status.Failed
             return self.status
 
         #: Update the status to completed
-        job.status = COMPLETED
+        self._change(job, COMPLETED)
+        self.completed.append(job)
 
         #: Check if the workflow is already in a finished state
         if self.status in core.DONE_STATUS:
             return self.status
 
+        #: Release the jobs that depend on this job
+        self._resolve(job)
+
         #: Check if the workflow finished
         if self._finished():
             self.status = core.Status.Completed
             return self.status
 
         #: Check that the workflow can proceed from this point
-        if self._can_proceed():
+        if self._can_proceed() or self._waiting_on_inputs():
             self.status = core.Status.Running
             return self.status
         else:
@@ -320,35 +452,38 @@ class Workflow(object):
             self.status = core.Status.Failed
             return self.status
 
+    @span('workflow.next')
     def next(self):
         '''Return the next set of available jobs'''
-        available = []
-        skipped = []
-
         #: Check if the workflow is already in a finished state
         if self.status in core.DONE_STATUS:
-            return available
+            return []
 
-        for job in self.available:
-            if job.outputs and job.completed():
-                skipped.append(job)
-                continue
+        if not self._started:
+            self._start()
+
+        if self.retrying:
+            self._release_retries()
 
-            if job.ready() and job.status in READY_STATES:
-                self.available.remove(job)
-                self.running.append(job)
-                available.append(job)
-                job.status = RUNNING
+        if not self.ready and not self.running:
+            self._recheck_waiting()
 
-        for job in skipped:
-            self._skip(job)
+        (available, self.ready) = (self.ready, [])
+
+        for job in available:
+            del self.available[id(job)]
+            self.running[id(job)] = job
+            self._change(job, RUNNING)
 
         #: Check if any tasks are busy
         if available or self.running:
+            self.stalled_since = None
             self.status = core.Status.Running
         elif not self.available:
             #: Check if all jobs have been skipped
             self.status = core.Status.Completed
+        elif self.retrying or self._waiting_on_inputs():
+            self.status = core.Status.Running
         else:
             self._failed()
             self.status = core.Status.Failed
@@ -358,23 +493,252 @@ class Workflow(object):
     def cancel(self):
         ''' Sets the state of the workflow as cancelled'''
         self.status = core.Status.Cancelled
+        self.retrying.clear()
 
-        for job in self.available + self.running:
-            if job in RUNNING_STATES:
-                job.status = CANCELLED
+        for job in self.available.values() + self.running.values():
+            if job.status in RUNNING_STATES:
+                self._change(job, CANCELLED)
 
     def stop(self):
         ''' Sets the state of the workflow as stopped'''
         self.status = core.Status.Stopped
+        self.retrying.clear()
 
-        for job in self.available + self.running:
-            if job in RUNNING_STATES:
-                job.status = STOPPED
+        for job in self.available.values() + self.running.values():
+            if job.status in RUNNING_STATES:
+                self._change(job, STOPPED)
 
     def state(self):
         """Returns the state of the workflow"""
         return [job.state for job in self.jobs]
 
+    @property
+    def cursor(self):
+        """Returns the stamp of the latest change"""
+        history = self.history
+        return history[-1][0] if history else self.created
+
+    def changed(self, since):
+        """
+        Returns the (position, job) pairs changed after the since stamp.
+
+        Every job is returned when the stamp predates the workflow.
+        """
+        if since < self.created:
+            return list(enumerate(self.jobs))
+
+        history = self.history
+        start = bisect_right(history, (since, float('inf')))
+        positions = sorted(set(position for (_, position) in history[start:]))
+        return [(position, self.jobs[position]) for position in positions]
+
+    def pop_changes(self):
+        """Returns the (position, job) pairs changed since the last call"""
+        changes = [(self.positions[key], job)
+                   for (key, job) in self.changes.items()]
+        self.changes.clear()
+        return changes
+
+    def restore(self, states):
+        """
+        Restores the jobs that finished before the workflow was reloaded.
+
+        The states map the position of a job to its saved status, info and
+        attempts. Completed and skipped jobs are not checked or run again,
+        the other jobs keep the attempts they already used.
+        """
+        for (position, (status, info, attempts)) in sorted(states.items()):
+            if position >= len(self.jobs):
+                continue
+
+            job = self.jobs[position]
+            job.attempts = attempts
+
+            if status not in (COMPLETED, SKIPPED):
+                continue
+
+            job.status = status
+            job.info = info
+            del self.available[id(job)]
+            self.completed.append(job)
+            self._resolve(job)
+
+    def rehydrate(self, states, status):
+        """
+        Restores a finished workflow from its saved job states.
+
+        The workflow is not scheduled again, it only reports its state.
+        """
+        for (position, (job_status, info, attempts)) in states.items():
+            if position < len(self.jobs):
+                job = self.jobs[position]
+                job._status = job_status
+                job._info = info
+                job.attempts = attempts
+
+        self.status = status
+        self.available.clear()
+        self.completed = list(self.jobs)
+        self._started = True
+
+    def footprint(self):
+        """Returns an estimate of the memory held by the jobs in bytes"""
+        return sum(_footprint(job) for job in self.jobs)
+
+    def recheck(self):
+        """Rechecks the inputs of the jobs waiting on them"""
+        for job in self.waiting.values():
+            job.invalidate_inputs()
+
+        self._recheck_waiting()
+
+    def requeue(self, jobs):
+        """Returns jobs that could not be run to wait on their inputs"""
+        for job in jobs:
+            if self.running.pop(id(job), None) is not None:
+                self.available[id(job)] = job
+                self.waiting[id(job)] = job
+                self._change(job, WAITING)
+
+        if not self.ready and not self.running:
+            self._waiting_on_inputs()
+
+    def missing_inputs(self):
+        """Returns the paths of the inputs the waiting jobs are missing"""
+        missing = OrderedDict()
+
+        for job in self.waiting.values():
+            allow_zero_length = job.options.allow_zero_length
+
+            for item in job.inputs:
+                path = _path(item)
+
+                if path not in missing and not _exists([item], allow_zero_length):
+                    missing[path] = True
+
+        return missing.keys()
+
+    @property
+    def retry_at(self):
+        """Returns when the next failed job may run again"""
+        if not self.retrying:
+            return None
+
+        return min(due for (due, _) in self.retrying.values())
+
+    @property
+    def deadline(self):
+        """Returns when the workflow stops waiting on missing inputs"""
+        if self.stalled_since is None:
+            return None
+
+        return self.stalled_since + self.input_timeout
+
+    def _start(self):
+        """
+        Checks the outputs of every job and the inputs of unblocked jobs.
+
+        This is the only pass over the whole workflow, afterwards only the
+        dependents of finished jobs are checked.
+        """
+        stat_cache.prefetch(_path(item) for job in self.available.values()
+                            for item in job.inputs + job.outputs)
+
+        for job in self.available.values():
+            if job.outputs and job.completed():
+                self._skip(job)
+                self._resolve(job)
+
+        self._started = True
+
+        for job in self.available.values():
+            if not self.blockers[id(job)]:
+                self._queue(job)
+
+    def _queue(self, job):
+        """Queues the job to be run once its inputs are ready"""
+        if job.ready():
+            self.ready.append(job)
+        else:
+            self.waiting[id(job)] = job
+            self._change(job, WAITING)
+
+    def _resolve(self, job):
+        """Releases the dependents of a finished job"""
+        finished = [job]
+
+        while finished:
+            for dependent in self.dependents.get(id(finished.pop()), ()):
+                key = id(dependent)
+                self.blockers[key] -= 1
+
+                if (not self._started or self.blockers[key] or
+                        key not in self.available):
+                    continue
+
+                if dependent.outputs and dependent.completed():
+                    self._skip(dependent)
+                    finished.append(dependent)
+                else:
+                    self._queue(dependent)
+
+    def _retry(self, job):
+        """
+        Returns a failed job to the workflow to run again.
+
+        The job waits retry_delay seconds before its first retry and twice
+        as long before each following retry, up to max_retry_delay.
+        """
+        job.restart()
+        delay = min(self.retry_delay * 2 ** (job.attempts - 2),
+                    self.max_retry_delay)
+        logger.info("WORKFLOW %s: retrying job %s in %s seconds (attempt %s)",
+                    self.name, job, delay, job.attempts)
+
+        self.available[id(job)] = job
+        self.retrying[id(job)] = (time() + delay, job)
+        self._change(job, RETRYING)
+        self.status = core.Status.Running
+        return self.status
+
+    def _release_retries(self):
+        """Queues the failed jobs whose backoff has passed"""
+        now = time()
+
+        for (key, (due, job)) in self.retrying.items():
+            if due <= now:
+                del self.retrying[key]
+                job.invalidate_inputs()
+                self._queue(job)
+
+    def _recheck_waiting(self):
+        """Returns whether any job waiting on its inputs became ready"""
+        for (key, job) in self.waiting.items():
+            if job.ready():
+                del self.waiting[key]
+                self.ready.append(job)
+
+        return len(self.ready) > 0
+
+    def _change(self, job, status):
+        """Sets the status of the job and records the change"""
+        job.status = status
+        self.changes[id(job)] = job
+
+        position = self.positions[id(job)]
+        stamp = next(_sequence)
+        self.stamps[position] = stamp
+        self.history.append((stamp, position))
+
+        if len(self.history) > 2 * len(self.jobs):
+            self._compact()
+
+    def _compact(self):
+        """Drops the changes superseded by a later change of the same job"""
+        stamps = self.stamps
+        self.history = [(stamp, position) for (stamp, position) in self.history
+                        if stamps[position] == stamp]
+
     def _finished(self):
         """Returns True when all jobs have been finished"""
         return not self.available and not self.running
@@ -383,22 +747,33 @@ class Workflow(object):
         """
         Returns whether the workflow can continue.
         """
-        #: Get the number of running jobs
-        total_running = len(self.running)
+        #: Proceed if a job is running, ready or waiting to be retried
+        if self.ready or self.running or self.retrying:
+            return True
 
-        #: Check if any jobs are still waiting
-        waiting = [job for job in self.available if job.status in READY_STATES]
+        return self._recheck_waiting()
 
-        #: Get the number of ready jobs
-        total_ready = len([job for job in waiting if job.ready()]) > 0
+    def _waiting_on_inputs(self):
+        """
+        Returns whether the stalled workflow should keep waiting on inputs.
 
-        #: Proceed if a job is running or a job is ready
-        return total_ready or total_running
+        A workflow with nothing to run waits on missing inputs until its
+        input timeout has passed.
+        """
+        if not self.waiting:
+            return False
+
+        if self.stalled_since is None:
+            self.stalled_since = time()
+
+        return time() < self.deadline
 
     def _failed(self):
         '''Sets a job into the failed state'''
-        for job in self.available:
-            job.status = FAILED
+        self.retrying.clear()
+
+        for job in self.available.values():
+            self._change(job, FAILED)
             #FIXME: add workflow change events
             #: Update the workflow log
             if self.log:
@@ -406,8 +781,9 @@ class Workflow(object):
 
     def _skip(self, job):
         '''Sets a job into a skipped state'''
-        job.status = SKIPPED
-        self.available.remove(job)
+        self._change(job, SKIPPED)
+        del self.available[id(job)]
+        self.waiting.pop(id(job), None)
         self.completed.append(job)
 
         #: Update the workflow log
@@ -416,7 +792,7 @@ class Workflow(object):
 
     def status_message(self):
         prefix = "WORKFLOW{0}: " % self.name
-        states = sorted(job.state for job in self.available + self.completed)
+        states = sorted(job.state for job in self.available.values() + self.completed)
 
         #: summarize the number of jobs in each state
         fields = [",".join([state, len(jobs)]) for state,jobs in groupby(states)]
@@ -427,7 +803,7 @@ class Workflow(object):
         return prefix + summary
 
     @classmethod
-    def from_object(cls, workflow_object):
+    def from_object(cls, workflow_object, overwrite=True):
         '''Generates a workflow from a python object.'''
         logger.info("######### Generate Workflow  ##########")
         job_objects = workflow_object.get('jobs', [])
@@ -438,6 +814,7 @@ class Workflow(object):
         name = workflow_object.get('name', 'unnamed')
         level = workflow_object.get('priority', 0)
         logfile = workflow_object.get('logfile')
+        max_tasks = int(workflow_object.get('max_tasks') or 0)
 
         #: Create the directory to the log file
         with utils.ignored(OSError, AttributeError):
@@ -455,11 +832,62 @@ class Workflow(object):
         if errors:
             raise WorkflowError("%s jobs where not valid." % len(errors), errors)
 
-        jobs = [Job.from_object(job_object) for job_object in job_objects]
-        workflow = cls(name, jobs, log=logfile, priority=level)
+        #: Options that are not known are not applied to the jobs
+        unknown = set(key for job_object in job_objects
+                      for key in (job_object.get('options') or {})
+                      if key not in JobOptions.fields)
+
+        if unknown:
+            logger.warn("WORKFLOW %s: the unknown job options %s were ignored",
+                        name, ', '.join(sorted(unknown)))
+
+        #: Outputs are the inputs of other jobs so their paths are shared
+        paths = {}
+        jobs = [Job.from_object(job_object, overwrite=overwrite, paths=paths)
+                for job_object in job_objects]
+        workflow = cls(name, jobs, log=logfile, priority=level,
+                       max_tasks=max_tasks)
         logger.info("WORKFLOW %s has been generated.", name)
         return workflow
 
+def _footprint(job):
+    """Returns an estimate of the memory held by the job in bytes"""
+    size = JOB_FOOTPRINT + len(job.cmd) + len(job.args)
+    size += sum(len(str(item)) for item in job.inputs + job.outputs)
+    size += sum(len(value) for value in job.info.values()
+                if isinstance(value, basestring))
+    return size
+
+def _build_graph(jobs):
+    """
+    Returns the dependents and number of blocking producers of each job.
+
+    A job depends on every other job that produces one of its inputs.
+    Inputs that are not produced by any job are external to the workflow.
+    """
+    producers = {}
+    dependents = {}
+    blockers = {}
+
+    for job in jobs:
+        for item in job.outputs:
+            producers.setdefault(_path(item), []).append(job)
+
+    for job in jobs:
+        dependencies = OrderedDict()
+
+        for item in job.inputs:
+            for producer in producers.get(_path(item), ()):
+                if producer is not job:
+                    dependencies[id(producer)] = producer
+
+        blockers[id(job)] = len(dependencies)
+
+        for producer in dependencies.values():
+            dependents.setdefault(id(producer), []).append(job)
+
+    return (dependents, blockers)
+
 def filter_options(options):
     """
     Returns the set of filtered options that are specified
@@ -467,6 +895,19 @@ def filter_options(options):
     return {key : value for (key, value) in options.iteritems()
                 if value is not None}
 
+def _valid_retries(value):
+    """
+    Returns whether the retries option is missing or a whole number that is
+    not negative
+    """
+    if value is None:
+        return True
+
+    try:
+        return int(value) >= 0 and int(value) == float(value)
+    except (TypeError, ValueError):
+        return False
+
 def validate_job(job_object):
     """
     Returns if the job is valid or gives a reason why invalid.
@@ -476,6 +917,7 @@ def validate_job(job_object):
     args = job_object.get('args', [])
     inputs = job_object.get('inputs', []) or []
     outputs = job_object.get('outputs', []) or []
+    options = job_object.get('options', {}) or {}
 
     if not cmd:
         return (False, "The command name was not specified")
@@ -495,6 +937,12 @@ def validate_job(job_object):
     if any(fp is None for fp in outputs):
         return (False, "An output was invalid")
 
+    if not isinstance(options, dict):
+        return (False, "The job expected a dictionary of options")
+
+    if not _valid_retries(options.get('retries')):
+        return (False, "The number of retries was invalid")
+
     return (True, "The job has been validated")
 
 class WorkflowError(Exception):
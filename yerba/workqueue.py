@@ -1,19 +1,34 @@
 # -*- coding: utf-8 -*-
 from __future__ import division
 
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime
 from logging import getLogger
 from os.path import abspath, basename
 from sys import exit
+from time import time
 
 import work_queue as wq
 
-from yerba.core import TASK_DONE
-from yerba.services import Service
+from yerba.metrics import registry
+from yerba.services import Executor, DISPATCH_SIZE, WORKQUEUE
+from yerba.utils import ignored
 
 logger = getLogger('yerba.workqueue')
 name = "yerba"
 MAX_OUTPUT = 65536
+BATCH_SIZE = 100
+FAILED_WORKER_TIMEOUT = 60
+FAILED_WORKER_LIMIT = 3
+STATS_INTERVAL = 5
+
+#: work_queue statistics reported as metrics
+STATS_FIELDS = ('total_send_time', 'total_receive_time', 'total_bytes_sent',
+                'total_bytes_received', 'total_workers_joined',
+                'total_workers_removed', 'total_tasks_complete',
+                'total_tasks_dispatched', 'tasks_waiting', 'tasks_complete',
+                'tasks_running', 'workers_init', 'workers_ready',
+                'workers_busy', 'workers_full')
 
 def get_task_info(task):
     dateformat="%d/%m/%y at %I:%M:%S%p"
@@ -33,16 +48,25 @@ def get_task_info(task):
         'elapsed' : execution_time,
         'taskid' : task.id,
         'returned' : task.return_status,
+        'worker' : getattr(task, 'hostname', None),
         'output' : repr(task.output[:MAX_OUTPUT]),
     }
 
-class WorkQueueService(Service):
-    name = "workqueue"
-    group = "scheduler"
+class WorkQueueService(Executor):
+    name = WORKQUEUE
 
-    def __init__(self, config, notifier):
-        self.tasks = {}
-        self.notifier = notifier
+    def __init__(self, config, notifier, name=None):
+        if name:
+            self.name = name
+
+        Executor.__init__(self, notifier)
+        #: Latest work_queue statistics as metric gauges
+        self.stats = []
+        self.sampled = 0
+        #: Workers connected when the statistics were sampled
+        self.workers = 0
+        #: host -> times of its recent failed tasks
+        self.host_failures = defaultdict(deque)
 
         try:
             self.project = config['project']
@@ -50,6 +74,14 @@ class WorkQueueService(Service):
             self.catalog_port = int(config['catalog_port'])
             self.port = int(config['port'])
             self.log = config['log']
+            self.batch_size = int(config.get('batch-size', BATCH_SIZE))
+            self.dispatch_size = int(config.get('dispatch-size', DISPATCH_SIZE))
+            self.max_tasks = int(config.get('workflow-max-tasks', 0))
+            self.min_priority = int(config.get('min-priority', 0))
+            self.failed_worker_timeout = int(config.get(
+                'failed-worker-timeout', FAILED_WORKER_TIMEOUT))
+            self.failed_worker_limit = int(config.get(
+                'failed-worker-limit', FAILED_WORKER_LIMIT))
 
             if config['debug']:
                 wq.set_debug_flag('all')
@@ -76,6 +108,8 @@ class WorkQueueService(Service):
             logger.exception("The work queue could not be started")
             exit(1)
 
+        registry.register_collector(self.collect)
+
     def stop(self):
         '''
         Removes all jobs from the queue and stops the work queue.
@@ -84,131 +118,157 @@ class WorkQueueService(Service):
                 self.project, self.queue.port)
         self.queue.shutdown_workers(0)
 
-    def schedule(self, iterable, name, priority=None):
-        '''
-        Schedules jobs into work_queue
-        '''
-        logger.info("######### WORKQUEUE SCHEDULING ##########")
-        for new_job in iterable:
-            logger.info('WORKQUEUE %s: The workflow %s is scheduling job %s', self.project, name, new_job)
+        with ignored(ValueError):
+            registry.unregister_collector(self.collect)
 
-            if not new_job.ready():
-                logger.info('WORKFLOW %s: Job %s was not scheduled waiting on inputs', name, new_job)
-                continue
+    def collect(self):
+        '''Returns the latest work_queue statistics as gauges'''
+        return self.stats
 
-            skip = False
+    def _sample(self):
+        '''Samples the work_queue statistics on the scheduler thread'''
+        now = time()
 
-            for (taskid, item) in self.tasks.items():
-                (names, job) = item
-                if new_job == job:
-                    if name not in names:
-                        names.append(name)
+        if now - self.sampled < STATS_INTERVAL:
+            return
 
-                    logger.info(('WORKQUEUE %s: This job has already been'
-                        'assigned to task %s'), self.project, taskid)
+        self.sampled = now
+        stats = self.queue.stats
+        labels = {"project" : self.project}
+        self.stats = [('yerba_workqueue_' + field, labels,
+                       getattr(stats, field, 0)) for field in STATS_FIELDS]
+        self.workers = sum(getattr(stats, field, 0) for field
+                           in ('workers_init', 'workers_ready',
+                               'workers_busy', 'workers_full'))
+
+    def capacity(self):
+        '''Returns the number of workers connected to work_queue'''
+        return self.workers
+
+    def hungry(self):
+        '''Returns whether work_queue can take another task'''
+        return self.queue.hungry()
+
+    def _run(self, new_job, name, priority):
+        '''Submits the job to work_queue as a new task'''
+        cmd = str(new_job)
+        task = wq.Task(cmd)
+        task.specify_priority(priority)
+
+        for input_file in new_job.inputs:
+            if isinstance(input_file, list) and input_file[1]:
+                remote_input = basename(abspath(input_file[0]))
+                task.specify_directory(str(input_file[0]), str(remote_input),
+                                wq.WORK_QUEUE_INPUT, recursive=1)
+            else:
+                remote_input = basename(abspath(input_file))
+                task.specify_input_file(str(input_file), str(remote_input),
+                                wq.WORK_QUEUE_INPUT)
+
+        for output_file in new_job.outputs:
+            if isinstance(output_file, list):
+                remote_output = basename(abspath(output_file[0]))
+                task.specify_directory(str(output_file[0]), str(remote_output),
+                                wq.WORK_QUEUE_OUTPUT, recursive=1, cache=False)
+            else:
+                remote_output = basename(abspath(output_file))
+                task.specify_file(str(output_file), str(remote_output),
+                                wq.WORK_QUEUE_OUTPUT, cache=False)
 
-                    self.tasks[taskid] = (names, job)
-                    skip = True
-                    break
+        return self.queue.submit(task)
 
-            if skip:
-                continue
+    def _failed_on(self, host):
+        '''
+        Records a failed task on the host.
 
-            cmd = str(new_job)
-            task = wq.Task(cmd)
+        A host that failed failed_worker_limit tasks within the last
+        failed_worker_timeout seconds is sent no tasks for that long.
+        '''
+        if not host or not self.failed_worker_timeout:
+            return
 
-            for input_file in new_job.inputs:
-                if isinstance(input_file, list) and input_file[1]:
-                    remote_input = basename(abspath(input_file[0]))
-                    task.specify_directory(str(input_file[0]), str(remote_input),
-                                    wq.WORK_QUEUE_INPUT, recursive=1)
-                else:
-                    remote_input = basename(abspath(input_file))
-                    task.specify_input_file(str(input_file), str(remote_input),
-                                    wq.WORK_QUEUE_INPUT)
+        now = time()
+        failures = self.host_failures[host]
+        failures.append(now)
 
-            for output_file in new_job.outputs:
-                if isinstance(output_file, list):
-                    remote_output = basename(abspath(output_file[0]))
-                    task.specify_directory(str(output_file[0]), str(remote_output),
-                                    wq.WORK_QUEUE_OUTPUT, recursive=1, cache=False)
-                else:
-                    remote_output = basename(abspath(output_file))
-                    task.specify_file(str(output_file), str(remote_output),
-                                    wq.WORK_QUEUE_OUTPUT, cache=False)
+        while failures[0] <= now - self.failed_worker_timeout:
+            failures.popleft()
 
-            new_id = self.queue.submit(task)
+        if len(failures) >= self.failed_worker_limit:
+            del self.host_failures[host]
+            self._block(host)
 
-            logger.info('WORKQUEUE %s: Task has been submited and assigned [id %s]', self.project, new_id)
+    def _block(self, host):
+        '''Stops work_queue from sending tasks to the host for a while'''
+        block = (getattr(self.queue, 'block_host_with_timeout', None) or
+                 getattr(self.queue, 'blacklist_with_timeout', None))
 
-            self.tasks[new_id] = ([name], new_job)
+        if not block:
+            logger.warn('WORKQUEUE %s: This work_queue can not block hosts, '
+                        'worker %s failed %s tasks and is still sent tasks',
+                        self.project, host, self.failed_worker_limit)
+            return
 
-        logger.info("######### WORKQUEUE END SCHEDULING ##########")
+        logger.info('WORKQUEUE %s: Blocking worker %s for %s seconds',
+                    self.project, host, self.failed_worker_timeout)
+        block(host, self.failed_worker_timeout)
 
     def update(self):
         '''
         Updates the scheduled workflow.
 
-        If a task is completed new tasks from the workflow will be scheduled.
+        Completed tasks are drained from work_queue up to the batch size and
+        each workflow is notified once with all of its finished jobs.
+        Pending jobs are then dispatched into the freed slots.
+        Returns whether a task was received or submitted.
         '''
-        task = self.queue.wait(0)
+        finished = OrderedDict()
+        received = 0
+        self._sample()
 
-        if not task:
-            return
+        while received < self.batch_size:
+            task = self.queue.wait(0)
 
-        logger.info("######### WORKQUEUE UPDATING ##########")
-        logger.info("WORKQUEUE %s: Fetching task from the work queue",
-                self.project)
+            if not task:
+                break
 
-        try:
-            logger.debug("INSPECTING TASK: %s", str(task))
-            logger.debug(('WORKQUEUE %s: Recieved task %s from work_queue with'
-                ' return_status %s'), self.project, task.id, task.return_status)
-        except:
-            logger.debug("Couldn't inspect the task")
-
-        if task.id not in self.tasks:
-            logger.info(('WORKQUEUE %s: The job for id %s could ',
-                'not be found.'), self.project, task.id)
-            return
+            received += 1
 
-        (names, job) = self.tasks[task.id]
-        info = get_task_info(task)
-        del self.tasks[task.id]
+            try:
+                logger.debug("INSPECTING TASK: %s", str(task))
+                logger.debug(('WORKQUEUE %s: Recieved task %s from work_queue '
+                    'with return_status %s'), self.project, task.id,
+                    task.return_status)
+            except:
+                logger.debug("Couldn't inspect the task")
 
-        for workflow in names:
-            self.notifier.notify(TASK_DONE, workflow, job, info)
+            if task.id not in self.tasks:
+                logger.info('WORKQUEUE %s: The job for id %s could not be found.',
+                    self.project, task.id)
+                continue
 
-        logger.info("######### WORKQUEUE END UPDATING ##########")
+            info = get_task_info(task)
 
-    def cancel(self, name):
-        '''
-        Removes the jobs based on there job id task id from the queue.
-        '''
-        for (taskid, item) in self.tasks.items():
-            (names, job) = item
+            if info['returned'] != 0:
+                self._failed_on(info['worker'])
 
-            logger.info('WORKFLOW %s: Requesting task %s to be cancelled',
-                    name, taskid)
+            self._finish(task.id, info, finished)
 
-            if name in names:
-                names.remove(name)
-            else:
-                continue
+        dispatched = self._dispatch()
+        rejected = self._reject(finished)
 
-            if not names:
-                task = self.queue.cancel_by_taskid(taskid)
+        if not received and not rejected:
+            return dispatched > 0
 
-                if task:
-                    del self.tasks[taskid]
-                    logger.info("WORKQUEUE %s: The task %s was cancelled",
-                        self.project, task.taskid)
-                else:
-                    logger.error("WORKQUEUE %s: failed to cancel %s",
-                        self.project, taskid)
-            else:
-                msg = ('WORKQUEUE %s: The task %s was not cancelled '
-                        'workflows %s depend on the task')
-                logger.info(msg, self.project, taskid, ', '.join(names))
-                self.tasks[taskid] = (names, job)
+        logger.info("######### WORKQUEUE UPDATING ##########")
+        logger.info("WORKQUEUE %s: Fetched %s tasks from the work queue",
+                self.project, received)
+
+        self._notify(finished)
+
+        logger.info("######### WORKQUEUE END UPDATING ##########")
+        return True
 
+    def _cancel_task(self, taskid):
+        '''Cancels the task in work_queue'''
+        return bool(self.queue.cancel_by_taskid(taskid))